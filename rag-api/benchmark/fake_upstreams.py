@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIMENSION = 1024
+ENDPOINTS = ["chat", "embed", "query"]
+
+
+class LatencyDistribution:
+    """
+    Samples latencies in seconds from a spec like "fixed:0.05", "uniform:0.02:0.1",
+    "exponential:0.05" (mean) or "lognormal:0.8:0.3" (median and sigma).
+    """
+    def __init__(self, spec: str):
+        name, *params = spec.split(":")
+        self.name = name
+        self.params = [float(param) for param in params]
+        if name not in ("fixed", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.name == "fixed":
+            return self.params[0]
+        if self.name == "uniform":
+            return random.uniform(*self.params)
+        if self.name == "exponential":
+            return random.expovariate(1 / self.params[0])
+        median, sigma = self.params
+        return random.lognormvariate(np.log(median), sigma)
+
+
+def create_fake_upstreams(latencies: dict, error_rates: dict, retrieve_rate: float = 0.5, answer_words: int = 250) -> FastAPI:
+    """
+    Create an app that stands in for the OpenAI chat completions API and the Pinecone control plane,
+    embed and query APIs. Point the clients to it with OPENAI_BASE_URL=<url>/v1 and PINECONE_CONTROLLER_HOST=<url>.
+
+    `latencies` and `error_rates` map "chat", "embed" and "query" to a `LatencyDistribution` and to the
+    fraction of requests that fail with a 429 or a 500. The necessity check answers "True" with
+    probability `retrieve_rate`, and the other completions have `answer_words` words.
+    """
+    app = FastAPI(title="Fake OpenAI and Pinecone")
+
+    async def simulate(endpoint: str) -> JSONResponse | None:
+        await asyncio.sleep(latencies[endpoint].sample())
+        if random.random() < error_rates[endpoint]:
+            status = random.choice([429, 500])
+            return JSONResponse({"error": {"message": f"Simulated {status}", "code": status}}, status_code=status)
+        return None
+
+    def completion_text(prompt: str) -> str:
+        if "exactly one of the following tokens" in prompt:
+            return "True" if random.random() < retrieve_rate else "False"
+        if "refined query" in prompt:
+            # Restate the last user query, so every unique query gets its own embedding
+            last_query = prompt.split("Last user query:", 1)[1].split("Your goal:", 1)[0]
+            return f"Research papers about {last_query.strip()}"
+        return " ".join(random.choice(["the", "article", "learning", "model", "score", "relevant"]) for _ in range(answer_words))
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = body["messages"][-1]["content"]
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": 0, "total_tokens": 0}
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body["model"]}
+
+        if not body.get("stream"):
+            error = await simulate("chat")
+            if error:
+                return error
+            text = completion_text(prompt)
+            usage["completion_tokens"] = len(text.split())
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        # Streamed completions spend 20% of the latency before the first token and spread the rest over the tokens
+        latency = latencies["chat"].sample()
+        await asyncio.sleep(latency * 0.2)
+        if random.random() < error_rates["chat"]:
+            return JSONResponse({"error": {"message": "Simulated 500", "code": 500}}, status_code=500)
+        words = completion_text(prompt).split()
+
+        async def chunks():
+            for i, word in enumerate(words):
+                delta = {"content": word if i == 0 else " " + word}
+                yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})}\n\n"
+                await asyncio.sleep(latency * 0.8 / len(words))
+            usage["completion_tokens"] = len(words)
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model", "created": 0, "owned_by": "openai"}]}
+
+    @app.get("/indexes/{name}")
+    async def describe_index(name: str, request: Request):
+        return {
+            "name": name,
+            "dimension": EMBEDDING_DIMENSION,
+            "metric": "cosine",
+            "host": str(request.base_url).rstrip("/"),
+            "spec": {"serverless": {"cloud": "aws", "region": "us-east-1"}},
+            "status": {"ready": True, "state": "Ready"},
+            "deletion_protection": "disabled",
+            "vector_type": "dense",
+            # Shape of the 2026-07 API, read by the newer clients
+            "schema": {"fields": {"values": {"type": "dense_vector", "dimension": EMBEDDING_DIMENSION, "metric": "cosine"}}},
+            "deployment": {"deployment_type": "managed", "cloud": "aws", "region": "us-east-1"},
+        }
+
+    @app.get("/indexes")
+    async def list_indexes(request: Request):
+        return {"indexes": [await describe_index("academic-papers", request)]}
+
+    @app.post("/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        error = await simulate("embed")
+        if error:
+            return error
+        data = []
+        for item in body["inputs"]:
+            # Deterministic unit vectors, so equal texts get equal embeddings
+            seed = int.from_bytes(hashlib.sha256(item["text"].encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSION)
+            data.append({"values": (vector / np.linalg.norm(vector)).tolist(), "vector_type": "dense"})
+        return {"model": body["model"], "vector_type": "dense", "data": data, "usage": {"total_tokens": 10 * len(data)}}
+
+    @app.api_route("/describe_index_stats", methods=["GET", "POST"])
+    async def describe_index_stats():
+        return {"namespaces": {"": {"vectorCount": 74000}}, "dimension": EMBEDDING_DIMENSION, "indexFullness": 0.0, "totalVectorCount": 74000}
+
+    @app.post("/query")
+    async def query(request: Request):
+        body = await request.json()
+        error = await simulate("query")
+        if error:
+            return error
+        top_k = body.get("topK", body.get("top_k", 3))
+        matches = []
+        for i in range(top_k):
+            doc_id = f"{random.randint(1990, 2023)}.acl-{random.randint(1, 99999)}"
+            match = {"id": doc_id, "score": round(0.9 - 0.02 * i, 4)}
+            if body.get("includeValues", body.get("include_values")):
+                match["values"] = np.random.default_rng(i).standard_normal(EMBEDDING_DIMENSION).tolist()
+            if body.get("includeMetadata", body.get("include_metadata")):
+                match["metadata"] = {
+                    "title": f"A study of topic {doc_id}",
+                    "abstract": "Lorem ipsum dolor sit amet. " * 40,
+                    "acl_id": doc_id,
+                    "url": f"https://aclanthology.org/{doc_id}",
+                }
+            matches.append(match)
+        return {"matches": matches, "namespace": "", "usage": {"read_units": 5}}
+
+    return app
+
+
+DEFAULT_LATENCIES = {"chat": "lognormal:0.8:0.3", "embed": "lognormal:0.05:0.3", "query": "lognormal:0.04:0.3"}
+
+
+def parse_per_endpoint(values: list[str] | None, defaults: dict) -> dict:
+    """Parse ["chat=...", "embed=..."] options over the defaults of each endpoint."""
+    result = dict(defaults)
+    for value in values or []:
+        endpoint, spec = value.split("=", 1)
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {endpoint}, expected one of {ENDPOINTS}")
+        result[endpoint] = spec
+    return result
+
+
+def add_upstream_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", action="append", metavar="ENDPOINT=SPEC",
+                        help=f"Latency of chat, embed or query, e.g. chat=fixed:0.5 (defaults: {DEFAULT_LATENCIES})")
+    parser.add_argument("--error-rate", action="append", metavar="ENDPOINT=RATE", help="Fraction of failed requests, e.g. chat=0.01")
+    parser.add_argument("--retrieve-rate", type=float, default=0.5, help="Probability that the necessity check answers True")
+
+
+def upstreams_from_arguments(args) -> FastAPI:
+    latencies = parse_per_endpoint(args.latency, DEFAULT_LATENCIES)
+    error_rates = parse_per_endpoint(args.error_rate, {endpoint: "0" for endpoint in ENDPOINTS})
+    return create_fake_upstreams(
+        {endpoint: LatencyDistribution(spec) for endpoint, spec in latencies.items()},
+        {endpoint: float(rate) for endpoint, rate in error_rates.items()},
+        retrieve_rate=args.retrieve_rate
+    )
+
+
+if __name__ == "__main__":
+    # Example: python -m benchmark.fake_upstreams --port 9000 --latency chat=fixed:0.5 --error-rate chat=0.01
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local stand-ins for OpenAI and Pinecone.")
+    parser.add_argument("--port", type=int, default=9000)
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+
+    uvicorn.run(upstreams_from_arguments(args), host="127.0.0.1", port=args.port, log_level="warning")
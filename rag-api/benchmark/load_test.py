@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import numpy as np
+
+from benchmark.fake_upstreams import add_upstream_arguments
+
+# Run from rag-api/: python -m benchmark.load_test
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPICS = [
+    "active learning for named entity recognition",
+    "low-resource machine translation",
+    "evaluation metrics for text summarization",
+    "bias in word embeddings",
+    "dialogue state tracking",
+    "cross-lingual transfer with multilingual encoders",
+    "data augmentation for question answering",
+    "interpretability of attention heads",
+]
+FOLLOW_UPS = [
+    "Which of these articles uses the largest dataset?",
+    "Are there more recent papers on this?",
+    "Now show me work on {topic} instead.",
+    "Summarize the second article.",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    """Waits until `url` answers with 200 (e.g. /readyz, once the API is warm)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} before {url} was up")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} was not up after {timeout}s")
+
+
+def start_servers(args) -> tuple[str, subprocess.Popen, list[subprocess.Popen]]:
+    """
+    Starts the fake upstreams and the API, pointing the OpenAI and Pinecone clients to the fakes.
+    Returns the API url, the API process and all the started processes.
+    """
+    upstream_port, api_port = free_port(), free_port()
+    upstream_command = [sys.executable, "-m", "benchmark.fake_upstreams", "--port", str(upstream_port),
+                        "--retrieve-rate", str(args.retrieve_rate)]
+    for latency in args.latency or []:
+        upstream_command += ["--latency", latency]
+    for error_rate in args.error_rate or []:
+        upstream_command += ["--error-rate", error_rate]
+    upstreams = subprocess.Popen(upstream_command, cwd=API_DIR)
+    wait_until_up(f"http://127.0.0.1:{upstream_port}/indexes", upstreams)
+
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{upstream_port}/v1",
+        "PINECONE_CONTROLLER_HOST": f"http://127.0.0.1:{upstream_port}",
+        "OPEN_AI_KEY": os.getenv("OPEN_AI_KEY", "benchmark"),
+        "PINECONE_API_KEY": os.getenv("PINECONE_API_KEY", "benchmark"),
+        "SERVER_TIMING_HEADER": "true",
+    }
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--log-level", "warning"],
+        cwd=API_DIR, env=env
+    )
+    url = f"http://127.0.0.1:{api_port}"
+    wait_until_up(f"{url}/readyz", api)
+    return url, api, [upstreams, api]
+
+
+def build_payload(turns: int, stream_id: int, request_id: int) -> dict:
+    """
+    A query with `turns` previous turns. Every query is unique, so the embedding and semantic caches
+    do not hide the cost of the pipeline.
+    """
+    tag = uuid.uuid4().hex[:8]
+    topic = TOPICS[(stream_id + request_id) % len(TOPICS)]
+    context = []
+    for turn in range(turns):
+        context.append({
+            "query": f"Papers about {TOPICS[(stream_id + turn) % len(TOPICS)]} ({tag})",
+            "response": "1. A study of the topic. " + "The article proposes a model and reports its score. " * 20,
+        })
+    if turns == 0:
+        query = f"{topic} {tag}"
+    else:
+        query = FOLLOW_UPS[request_id % len(FOLLOW_UPS)].format(topic=topic) + f" ({tag})"
+    return {"query": query, "context": context}
+
+
+def parse_server_timing(header: str | None) -> dict:
+    """Parses "refinement;dur=145.6, answer;dur=59.1" into {stage: milliseconds}, adding up repeated stages."""
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, duration = entry.strip().partition(";dur=")
+        if name and duration:
+            timings[name] = timings.get(name, 0.0) + float(duration)
+    return timings
+
+
+def read_rss_bytes(pid: int) -> int | None:
+    """Resident memory of a process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+async def sample_memory(pid: int, samples: list, stop: asyncio.Event, interval: float = 0.05):
+    while not stop.is_set():
+        rss = read_rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+
+async def send(client: httpx.AsyncClient, endpoint: str, payload: dict) -> dict:
+    start = time.perf_counter()
+    try:
+        if endpoint == "/query/stream":
+            first_token, failed = None, False
+            async with client.stream("POST", endpoint, json=payload) as response:
+                async for line in response.aiter_lines():
+                    if first_token is None and line == "event: token":
+                        first_token = time.perf_counter() - start
+                    # Errors after the response started are sent as an error event
+                    failed = failed or line == "event: error"
+                headers = response.headers
+            ok = response.status_code == 200 and not failed
+            result = {"ok": ok, "status": "stream error" if failed else response.status_code, "first_token": first_token}
+        else:
+            response = await client.post(endpoint, json=payload)
+            headers = response.headers
+            result = {"ok": response.status_code == 200, "status": response.status_code}
+    except httpx.HTTPError as e:
+        return {"ok": False, "status": type(e).__name__, "latency": time.perf_counter() - start, "stages": {}}
+    result["latency"] = time.perf_counter() - start
+    result["stages"] = parse_server_timing(headers.get("server-timing"))
+    return result
+
+
+async def run_level(url: str, endpoint: str, concurrency: int, turns: int, requests: int, pid: int | None) -> dict:
+    """Sends `requests` queries with `concurrency` of them in flight at any time."""
+    queue = asyncio.Queue()
+    for request_id in range(requests):
+        queue.put_nowait(request_id)
+    results = []
+
+    async def worker(stream_id: int):
+        while True:
+            try:
+                request_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results.append(await send(client, endpoint, build_payload(turns, stream_id, request_id)))
+
+    memory_samples, stop = [], asyncio.Event()
+    baseline_rss = read_rss_bytes(pid) if pid else None
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits) as client:
+        sampler = asyncio.create_task(sample_memory(pid, memory_samples, stop)) if pid else None
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(stream_id) for stream_id in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        if sampler:
+            await sampler
+
+    return summarize(results, elapsed, concurrency, turns, baseline_rss, memory_samples)
+
+
+def percentiles(values: list[float]) -> dict | None:
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def summarize(results: list[dict], elapsed: float, concurrency: int, turns: int, baseline_rss: int | None, memory_samples: list) -> dict:
+    succeeded = [result for result in results if result["ok"]]
+    errors = {}
+    for result in results:
+        if not result["ok"]:
+            errors[str(result["status"])] = errors.get(str(result["status"]), 0) + 1
+
+    stage_names = sorted({name for result in succeeded for name in result["stages"]})
+    summary = {
+        "concurrency": concurrency,
+        "turns": turns,
+        "requests": len(results),
+        "errors": errors,
+        "throughput_rps": len(succeeded) / elapsed if elapsed else 0.0,
+        "latency_s": percentiles([result["latency"] for result in succeeded]),
+        # Milliseconds, over the requests that ran each stage
+        "stages_ms": {name: percentiles([r["stages"][name] for r in succeeded if name in r["stages"]]) for name in stage_names},
+    }
+    first_tokens = [result["first_token"] for result in succeeded if result.get("first_token") is not None]
+    if first_tokens:
+        summary["first_token_s"] = percentiles(first_tokens)
+    if baseline_rss and memory_samples:
+        peak = max(memory_samples)
+        summary["peak_rss_mb"] = peak / 2**20
+        summary["rss_per_in_flight_request_kb"] = (peak - baseline_rss) / concurrency / 1024
+    return summary
+
+
+def print_summary(summary: dict):
+    latency = summary["latency_s"] or {"p50": float("nan"), "p95": float("nan"), "p99": float("nan")}
+    errors = sum(summary["errors"].values())
+    memory = f"{summary['rss_per_in_flight_request_kb']:8.0f}" if "rss_per_in_flight_request_kb" in summary else "       -"
+    print(f"{summary['concurrency']:>11} {summary['turns']:>5} {summary['throughput_rps']:>8.2f} "
+          f"{latency['p50']:>7.3f} {latency['p95']:>7.3f} {latency['p99']:>7.3f} {errors:>6} {memory}")
+    for name, stage in summary["stages_ms"].items():
+        print(f"{'':>17} {name:<12} p50 {stage['p50']:8.1f} ms  p95 {stage['p95']:8.1f} ms  p99 {stage['p99']:8.1f} ms")
+
+
+def parse_levels(value: str) -> list[int]:
+    return [int(level) for level in value.split(",")]
+
+
+async def main(args):
+    processes = []
+    try:
+        if args.url:
+            url, pid = args.url.rstrip("/"), args.pid
+        else:
+            url, api, processes = start_servers(args)
+            pid = api.pid
+
+        print(f"Benchmarking {url}{args.endpoint}, {args.requests} requests per level")
+        print(f"{'concurrency':>11} {'turns':>5} {'req/s':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'errors':>6} {'KB/req':>8}")
+        summaries = []
+        for turns in args.turns:
+            for concurrency in args.concurrency:
+                # A few requests first, so the connection pools and lazy clients are ready
+                await run_level(url, args.endpoint, min(concurrency, 4), turns, min(concurrency, 4), None)
+                summary = await run_level(url, args.endpoint, concurrency, turns, args.requests, pid)
+                print_summary(summary)
+                summaries.append(summary)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"endpoint": args.endpoint, "latency": args.latency, "error_rate": args.error_rate, "levels": summaries}, f, indent=2)
+            print(f"Report written to {args.output}")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    # Example: python -m benchmark.load_test --concurrency 1,8,32 --turns 0,4 --latency chat=lognormal:1.2:0.4 --output report.json
+    parser = argparse.ArgumentParser(description="Load test of the RAG API against fake OpenAI and Pinecone upstreams.")
+    parser.add_argument("--url", help="Benchmark an API that is already running instead of starting one with fake upstreams")
+    parser.add_argument("--pid", type=int, help="Process id of the API given with --url, to sample its memory")
+    parser.add_argument("--endpoint", default="/query/", choices=["/query/", "/query/stream"])
+    parser.add_argument("--concurrency", type=parse_levels, default=[1, 4, 16, 64], help="Comma-separated concurrency levels")
+    parser.add_argument("--turns", type=parse_levels, default=[0, 2, 6], help="Comma-separated conversation lengths")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per level")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    add_upstream_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
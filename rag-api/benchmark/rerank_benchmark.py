@@ -0,0 +1,59 @@
+import argparse
+import random
+import timeit
+
+import numpy as np
+
+from services.rerank import MMRReranker
+
+# Run from rag-api/: python -m benchmark.rerank_benchmark
+EMBEDDING_DIMENSION = 1024
+WORDS = [
+    "active", "learning", "natural", "language", "processing", "model", "data", "translation", "evaluation", "neural",
+    "summarization", "dialogue", "embeddings", "transfer", "multilingual", "attention", "annotation", "corpus",
+]
+QUERY = "active learning for natural language processing"
+
+
+def make_candidates(count: int, seed: int = 0) -> list[dict]:
+    """Candidates shaped like the ones returned by the vector stores with `include_values=True`."""
+    rng = np.random.default_rng(seed)
+    words = random.Random(seed)
+    return [
+        {
+            "id": str(i),
+            "title": " ".join(words.choices(WORDS, k=10)),
+            "abstract": " ".join(words.choices(WORDS, k=150)),
+            "url": None,
+            "year": 2020,
+            "score": 0.5,
+            "values": rng.standard_normal(EMBEDDING_DIMENSION).astype(np.float32),
+        }
+        for i in range(count)
+    ]
+
+
+def measure(call, number: int) -> float:
+    """Best mean duration of `call` over 5 repeats, in milliseconds."""
+    return min(timeit.repeat(call, number=number, repeat=5)) / number * 1000
+
+
+if __name__ == "__main__":
+    # Example: python -m benchmark.rerank_benchmark --candidates 50 --top-k 5
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the MMR rerank.")
+    parser.add_argument("--candidates", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200, help="Reranks per repeat")
+    args = parser.parse_args()
+
+    candidates = make_candidates(args.candidates)
+    query_vector = np.random.default_rng(1).standard_normal(EMBEDDING_DIMENSION).tolist()
+    reranker = MMRReranker(args.candidates, diversity_lambda=0.7, title_boost=0.05, abstract_boost=0.02)
+    without_boosts = MMRReranker(args.candidates, diversity_lambda=0.7)
+    # Pinecone returns the values as JSON lists, converted once to a float32 matrix when the matches are parsed
+    values = [candidate["values"].tolist() for candidate in candidates]
+
+    print(f"{args.candidates} candidates, top {args.top_k}:")
+    print(f"  rerank:                   {measure(lambda: reranker.rerank(query_vector, QUERY, candidates, args.top_k), args.number):.3f} ms")
+    print(f"  rerank without boosts:    {measure(lambda: without_boosts.rerank(query_vector, QUERY, candidates, args.top_k), args.number):.3f} ms")
+    print(f"  Pinecone values to array: {measure(lambda: np.asarray(values, dtype=np.float32), args.number):.3f} ms")
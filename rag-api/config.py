@@ -7,7 +7,116 @@ PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 OPEN_AI_KEY = os.getenv("OPEN_AI_KEY")
 INDEX_NAME = "academic-papers" # Adjust if needed
 
-if not PINECONE_API_KEY:
-    raise ValueError("PINECONE_API_KEY not found in environment variables.")
-if not OPEN_AI_KEY:
-    raise ValueError("OPEN_AI_KEY not found in environment variables.")
+# Fetch documents in parallel with the necessity check on follow-up turns (trades extra Pinecone queries for latency)
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+
+# Query embedding cache (size 0 disables it). Set a path to also persist it in SQLite, shared between workers.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+
+# Answer cache for first-turn queries (size 0 disables it). Reuses an answer when the cosine similarity reaches the threshold.
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "0"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+# Document index: "pinecone", or "local" to search an index built with services/local_vector_store.py
+VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+
+# How follow-up turns decide whether to retrieve new documents: "llm", or "embedding" to compare the refined query
+# with the previous turns locally and only ask the LLM when the similarity falls between the two thresholds
+NECESSITY_STRATEGY = os.getenv("NECESSITY_STRATEGY", "llm")
+NECESSITY_LOW_THRESHOLD = float(os.getenv("NECESSITY_LOW_THRESHOLD", "0.78"))
+NECESSITY_HIGH_THRESHOLD = float(os.getenv("NECESSITY_HIGH_THRESHOLD", "0.88"))
+# Fraction of local decisions also checked with the LLM, to measure their agreement
+NECESSITY_ORACLE_SAMPLE_RATE = float(os.getenv("NECESSITY_ORACLE_SAMPLE_RATE", "0.0"))
+
+# Skip the LLM refinement of first-turn queries that are already short search phrases in one of these languages
+REFINEMENT_BYPASS = os.getenv("REFINEMENT_BYPASS", "false").lower() == "true"
+REFINEMENT_BYPASS_MAX_WORDS = int(os.getenv("REFINEMENT_BYPASS_MAX_WORDS", "12"))
+REFINEMENT_BYPASS_LANGUAGES = os.getenv("REFINEMENT_BYPASS_LANGUAGES", "en").split(",")
+# Fraction of bypassed queries also refined in the background, to measure the overlap of the retrieved documents
+REFINEMENT_BYPASS_SHADOW_RATE = float(os.getenv("REFINEMENT_BYPASS_SHADOW_RATE", "0.0"))
+
+# Batch queries: maximum items per request and maximum items processed at the same time
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
+
+# Return the duration of each stage of the request in a Server-Timing header
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "false").lower() == "true"
+
+# Token budgets of the conversation history in the refinement, necessity and answer prompts.
+# The turns that do not fit are replaced by a rolling summary, updated in the background (if enabled).
+CONTEXT_TOKEN_BUDGET_REFINEMENT = int(os.getenv("CONTEXT_TOKEN_BUDGET_REFINEMENT", "1000"))
+CONTEXT_TOKEN_BUDGET_NECESSITY = int(os.getenv("CONTEXT_TOKEN_BUDGET_NECESSITY", "1000"))
+CONTEXT_TOKEN_BUDGET_ANSWER = int(os.getenv("CONTEXT_TOKEN_BUDGET_ANSWER", "3000"))
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "true").lower() == "true"
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "300"))
+CONTEXT_SUMMARY_CACHE_SIZE = int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", "1024"))
+
+# Server-side sessions, so clients only send the new query: "memory" (per worker), "sqlite" (shared by
+# the workers on a machine) or "none". Sessions are evicted when unused for SESSION_TTL seconds or above SESSION_MAX_SESSIONS
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db")
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "50"))
+
+# Arrow file built with services/document_store.py. If set, Pinecone queries only return ids and scores,
+# and the title, abstract, url and year of the documents are read from this file
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "")
+
+# Documents sent to the answer prompts
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+# Fetch RERANK_CANDIDATES documents with their vectors and pick the final ones locally with Maximal Marginal
+# Relevance (lambda 1 is pure relevance), boosting the documents whose title and abstract contain the query terms
+RERANK = os.getenv("RERANK", "false").lower() == "true"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", "0.7"))
+RERANK_TITLE_BOOST = float(os.getenv("RERANK_TITLE_BOOST", "0.05"))
+RERANK_ABSTRACT_BOOST = float(os.getenv("RERANK_ABSTRACT_BOOST", "0.02"))
+
+# Share one upstream call among the identical completions, embeddings and Pinecone queries that run at the same time
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() == "true"
+
+# Scheduling of the upstream calls: at most *_MAX_CONCURRENCY calls at the same time and *_RATE_LIMIT calls per second
+# (0 for no limit) to each upstream, sized to the quotas. Rate limits, server errors and timeouts are retried up to
+# UPSTREAM_MAX_RETRIES times with jittered exponential backoff, and every attempt is cut at UPSTREAM_TIMEOUT seconds
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_RATE_LIMIT = float(os.getenv("OPENAI_RATE_LIMIT", "0"))
+PINECONE_MAX_CONCURRENCY = int(os.getenv("PINECONE_MAX_CONCURRENCY", "64"))
+PINECONE_RATE_LIMIT = float(os.getenv("PINECONE_RATE_LIMIT", "0"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.25"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+# Seconds a query request may take. ANSWER_RESERVE of them are kept for the final completion: when the earlier
+# stages run out of time, the refinement is skipped and follow-up turns are answered without new documents
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "60"))
+ANSWER_RESERVE = float(os.getenv("ANSWER_RESERVE", "20"))
+# Reject queries with a 503 (and a Retry-After of at least LOAD_SHED_RETRY_AFTER seconds) while more than
+# LOAD_SHED_QUEUE_THRESHOLD calls wait for an upstream
+LOAD_SHED_QUEUE_THRESHOLD = int(os.getenv("LOAD_SHED_QUEUE_THRESHOLD", "256"))
+LOAD_SHED_RETRY_AFTER = float(os.getenv("LOAD_SHED_RETRY_AFTER", "2"))
+
+# Open the upstream connections and prime the embed endpoint when a worker starts; /readyz fails until they are warm.
+# WARM_UP_CONNECTIONS connections are opened per upstream, and a failed warm-up is retried every WARM_UP_RETRY_INTERVAL seconds
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+WARM_UP_CONNECTIONS = int(os.getenv("WARM_UP_CONNECTIONS", "4"))
+WARM_UP_RETRY_INTERVAL = float(os.getenv("WARM_UP_RETRY_INTERVAL", "5"))
+# Seconds an idle OpenAI connection is kept open for reuse
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+# The Pinecone clients close the connections idle for 5 seconds (not configurable). If set, once warm, the Pinecone
+# connections are re-opened every PINECONE_KEEP_WARM_INTERVAL seconds without Pinecone traffic (0 disables it)
+PINECONE_KEEP_WARM_INTERVAL = float(os.getenv("PINECONE_KEEP_WARM_INTERVAL", "0"))
+
+
+def check_api_keys():
+    """
+    Raises if an API key is missing. Called when the server starts (not on import),
+    so the modules can be imported by tests and tools without credentials.
+    """
+    if not PINECONE_API_KEY:
+        raise ValueError("PINECONE_API_KEY not found in environment variables.")
+    if not OPEN_AI_KEY:
+        raise ValueError("OPEN_AI_KEY not found in environment variables.")
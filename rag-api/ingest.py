@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pyarrow.parquet as pq
+from pinecone import Pinecone
+
+from config import INDEX_NAME, PINECONE_API_KEY
+from services.local_vector_store import decode_embeddings
+
+METADATA_FIELDS = ["title", "abstract", "acl_id", "corpus_paper_id", "url"]
+
+
+class Checkpoint:
+    """
+    Persists how many batches were fully processed, so an interrupted run can resume.
+    Batches finish out of order, so only the contiguous prefix of finished batches is saved.
+    The batches are only meaningful for the same command, input and batch size, so a checkpoint
+    saved with other ones is refused instead of skipping or repeating rows.
+    """
+    def __init__(self, path: str | None, command: str, parquet_path: str, batch_size: int):
+        self.path = path
+        self.run = {"command": command, "parquet_path": os.path.abspath(parquet_path), "batch_size": batch_size}
+        self.completed = 0
+        self.finished = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            mismatches = [
+                f"{key}={saved.get(key)!r} (now {value!r})" for key, value in self.run.items() if saved.get(key) != value
+            ]
+            if mismatches:
+                raise ValueError(f"Checkpoint {path} was saved by another run: {', '.join(mismatches)}")
+            self.completed = saved["completed_batches"]
+
+    def mark_done(self, batch_number: int):
+        self.finished.add(batch_number)
+        while self.completed in self.finished:
+            self.finished.remove(self.completed)
+            self.completed += 1
+        if self.path:
+            with open(self.path, "w") as f:
+                json.dump({**self.run, "completed_batches": self.completed}, f)
+
+
+class Progress:
+    """Prints the processed rows and the throughput."""
+    def __init__(self, total: int, label: str):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.start = time.monotonic()
+
+    def add(self, rows: int):
+        self.done += rows
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        print(f"{self.label}: {self.done}/{self.total} rows, {rate:.0f} rows/s", flush=True)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        print(f"{self.label}: finished {self.done} rows in {elapsed:.1f}s ({self.done / max(elapsed, 1e-9):.0f} rows/s)")
+
+
+def run_batches(batches, workers: int, checkpoint: Checkpoint, progress: Progress):
+    """
+    Run `(batch_number, rows, task)` items on a pool of `workers` threads,
+    keeping a bounded number of batches in flight. Batches before the checkpoint are skipped.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+
+        def collect(done):
+            for future in done:
+                batch_number, rows = in_flight.pop(future)
+                future.result()
+                checkpoint.mark_done(batch_number)
+                progress.add(rows)
+
+        for batch_number, rows, task in batches:
+            if batch_number < checkpoint.completed:
+                continue
+            if len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(task)] = (batch_number, rows)
+        collect(wait(in_flight).done)
+
+
+def upsert_corpus(index, parquet_path: str, batch_size: int, workers: int, checkpoint: Checkpoint):
+    """
+    Stream the parquet in record batches and upsert its embeddings and metadata.
+    """
+    parquet = pq.ParquetFile(parquet_path)
+    columns = [name for name in METADATA_FIELDS + ["embedding"] if name in parquet.schema_arrow.names]
+    progress = Progress(parquet.metadata.num_rows - checkpoint.completed * batch_size, "upsert")
+
+    def make_task(batch):
+        def task():
+            vectors = decode_embeddings(batch.column("embedding"))
+            metadata = batch.drop_columns(["embedding"]).to_pylist()
+            index.upsert(vectors=[
+                {
+                    "id": meta["acl_id"],
+                    "values": values,
+                    "metadata": {**{key: value for key, value in meta.items() if value is not None}, "bd": "acl"}
+                }
+                for meta, values in zip(metadata, vectors.tolist())
+            ])
+        return task
+
+    def batches():
+        for batch_number, batch in enumerate(parquet.iter_batches(batch_size=batch_size, columns=columns)):
+            yield batch_number, batch.num_rows, make_task(batch)
+
+    run_batches(batches(), workers, checkpoint, progress)
+    progress.summary()
+
+
+def update_metadata(index, parquet_path: str, fields: list[str], batch_size: int, workers: int, checkpoint: Checkpoint):
+    """
+    Set the given parquet fields as metadata of every vector already in the index,
+    looking each id up in an id-indexed dictionary built in a single pass over the parquet.
+    Pinecone only updates one vector per request, so each batch is fetched and upserted back
+    with the merged metadata instead: two requests per batch rather than one per vector.
+    """
+    table = pq.read_table(parquet_path, columns=["acl_id"] + fields)
+    lookup = dict(zip(table.column("acl_id").to_pylist(), table.drop_columns(["acl_id"]).to_pylist()))
+
+    ids = []
+    for page in index.list():
+        # Older clients yield lists of ids, newer ones a ListResponse
+        ids.extend(page if isinstance(page, list) else [item.id for item in page.vectors])
+    progress = Progress(len(ids) - checkpoint.completed * batch_size, "update")
+
+    def make_task(batch_ids):
+        def task():
+            updates = {}
+            for vector_id in batch_ids:
+                metadata = {key: value for key, value in lookup.get(vector_id, {}).items() if value is not None}
+                if metadata:
+                    updates[vector_id] = metadata
+            if not updates:
+                return
+            vectors = index.fetch(ids=list(updates)).vectors
+            index.upsert(vectors=[
+                {"id": vector_id, "values": vector.values, "metadata": {**(vector.metadata or {}), **updates[vector_id]}}
+                for vector_id, vector in vectors.items()
+            ])
+        return task
+
+    def batches():
+        for batch_number, start in enumerate(range(0, len(ids), batch_size)):
+            batch_ids = ids[start:start + batch_size]
+            yield batch_number, len(batch_ids), make_task(batch_ids)
+
+    run_batches(batches(), workers, checkpoint, progress)
+    progress.summary()
+
+
+if __name__ == "__main__":
+    # Examples:
+    #   python ingest.py upsert acl-publication-info.74k.parquet --checkpoint upsert.json
+    #   python ingest.py update-metadata acl-publication-info.74k.parquet --fields url year
+    parser = argparse.ArgumentParser(description="Bulk ingestion of the ACL corpus into the Pinecone index.")
+    parser.add_argument("command", choices=["upsert", "update-metadata"])
+    parser.add_argument("parquet_path")
+    parser.add_argument("--fields", nargs="+", default=["url"], help="Metadata fields to set with update-metadata")
+    parser.add_argument("--batch-size", type=int, default=100, help="Vectors per upsert request (at most 1000)")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent requests to Pinecone")
+    parser.add_argument("--checkpoint", help="File to resume from and save progress to")
+    args = parser.parse_args()
+
+    try:
+        checkpoint = Checkpoint(args.checkpoint, args.command, args.parquet_path, args.batch_size)
+    except ValueError as e:
+        parser.error(str(e))
+    index = Pinecone(api_key=PINECONE_API_KEY).Index(INDEX_NAME)
+    if args.command == "upsert":
+        upsert_corpus(index, args.parquet_path, args.batch_size, args.workers, checkpoint)
+    else:
+        update_metadata(index, args.parquet_path, args.fields, args.batch_size, args.workers, checkpoint)
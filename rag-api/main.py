@@ -1,15 +1,85 @@
-from fastapi import FastAPI
+import asyncio
+import time
+from contextlib import asynccontextmanager, suppress
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from routes.health import health_router
+from routes.metrics import metrics_router
 from routes.rag import rag_router
 from fastapi.middleware.cors import CORSMiddleware
+from config import (
+    PINECONE_KEEP_WARM_INTERVAL, SERVER_TIMING_HEADER, WARM_UP, WARM_UP_CONNECTIONS, WARM_UP_RETRY_INTERVAL, check_api_keys
+)
+from services.metrics import REQUEST_DURATION, format_server_timing, request_timings
+from services.openai import openai_service
+from services.pinecone import pinecone_service
+from services.scheduling import UpstreamUnavailable, retry_after_header
+from services.warm_up import readiness, warm_up
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Check the API keys and warm up the upstream connections in the background when the server starts,
+    so the worker starts right away and /readyz tells when it can take traffic.
+    Close the async upstream connections when the server shuts down.
+    """
+    check_api_keys()
+    warm_up_task = None
+    if WARM_UP:
+        warm_up_task = asyncio.create_task(
+            warm_up(readiness, WARM_UP_CONNECTIONS, WARM_UP_RETRY_INTERVAL, keep_warm_interval=PINECONE_KEEP_WARM_INTERVAL)
+        )
+    else:
+        readiness.mark_ready()
+    yield
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await warm_up_task
+    await openai_service.close()
+    await pinecone_service.close()
 
 def create_app() -> FastAPI:
     """
     Create and configure the FastAPI application instance.
     """
-    app = FastAPI(title="Simple RAG API", version="1.0")
+    app = FastAPI(title="Simple RAG API", version="1.0", lifespan=lifespan)
 
     # Include your RAG router (the query endpoint)
     app.include_router(rag_router, prefix="/query", tags=["RAG Queries"])
+    app.include_router(metrics_router, tags=["Metrics"])
+    app.include_router(health_router, tags=["Health"])
+
+    @app.exception_handler(UpstreamUnavailable)
+    async def upstream_unavailable(request: Request, error: UpstreamUnavailable):
+        """
+        Answers the requests that were shed, ran out of time or found an upstream unavailable
+        with 503, 504 or 502, and a Retry-After header when it is known.
+        """
+        return JSONResponse({"detail": str(error)}, status_code=error.status_code, headers=retry_after_header(error))
+
+    @app.middleware("http")
+    async def record_timings(request: Request, call_next):
+        """
+        Collects the stage timings of the request, records its duration and,
+        if enabled, returns the timings in a Server-Timing header.
+        """
+        timings = []
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            request_timings.reset(token)
+        # The path of the matched route, with its parameters as placeholders so the label stays bounded
+        path = request.url.path if request.scope.get("route") else "unmatched"
+        for name, value in request.path_params.items():
+            path = path.replace(f"/{value}", f"/{{{name}}}")
+        REQUEST_DURATION.labels(path).observe(time.perf_counter() - start)
+        if SERVER_TIMING_HEADER and timings:
+            response.headers["Server-Timing"] = format_server_timing(timings)
+        return response
     
     # CORS settings, allow localhost:3000 for development
     app.add_middleware(
@@ -18,6 +88,7 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["Server-Timing"],
     )
 
     return app
@@ -0,0 +1,20 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from services.warm_up import readiness
+
+health_router = APIRouter()
+
+@health_router.get("/healthz")
+async def get_health():
+    """
+    Liveness probe: the worker is up and serving requests.
+    """
+    return {"status": "ok"}
+
+@health_router.get("/readyz")
+async def get_readiness():
+    """
+    Readiness probe: 200 once the upstream connections are warm, 503 (with the last warm-up error) until then.
+    """
+    return JSONResponse(readiness.get_status(), status_code=200 if readiness.ready else 503)
@@ -0,0 +1,11 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+metrics_router = APIRouter()
+
+@metrics_router.get("/metrics")
+def get_metrics():
+    """
+    Exposes the stage durations, token usage, branch and error counters in the Prometheus text format.
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,26 +1,369 @@
-from fastapi import APIRouter
-from pydantic import BaseModel
+import asyncio
+import json
+from dataclasses import dataclass
 
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from config import BATCH_CONCURRENCY, BATCH_MAX_ITEMS, LOCAL_INDEX_NPROBE, LOCAL_INDEX_PATH, RETRIEVAL_TOP_K, SPECULATIVE_RETRIEVAL, VECTOR_STORE
+from services.conversation import ConversationContext, conversation_summarizer
 from services.openai import openai_service
-from services.pinecone import pinecone_service
-from services.prompting import build_prompt_for_initial_message, build_prompt_to_check_necessity_of_retrieving_documents, build_prompt_for_intermediate_message_with_new_docs, build_prompt_for_intermediate_message_without_new_docs, build_prompt_for_query_refinement
+from services.local_vector_store import LocalVectorStore
+from services.metrics import BRANCHES
+from services.necessity import check_necessity_with_llm, necessity_checker
+from services.pinecone import EmbeddingBatcher, pinecone_service
+from services.refinement import refinement_bypass
+from services.rerank import reranker
+from services.scheduling import UpstreamUnavailable, admit_request, has_time_for, limiters, record_degradation, start_deadline
+from services.semantic_cache import semantic_cache
+from services.sessions import Session, session_store
+from services.prompting import build_prompt_for_initial_message, build_prompt_for_intermediate_message_with_new_docs, build_prompt_for_intermediate_message_without_new_docs, build_prompt_for_query_refinement
 
 rag_router = APIRouter()
 
+# Pinecone always embeds the queries, but the documents can be retrieved from a local index
+if VECTOR_STORE == "local":
+  vector_store = LocalVectorStore(LOCAL_INDEX_PATH, nprobe=LOCAL_INDEX_NPROBE)
+else:
+  vector_store = pinecone_service
+
+# Counters of the speculative retrieval mode
+retrieval_stats = {
+  "speculative_queries": 0,
+  "wasted_speculative_queries": 0,
+}
+
 class QueryRequest(BaseModel):
   query: str
-  context: list[dict]
+  context: list[dict] = []
+  # Continue a server-side session (see POST /query/sessions) instead of sending the context
+  session_id: str | None = None
 
 
 class QueryResponse(BaseModel):
     answer: str
+    # Similarity to the cached query whose answer was reused, if the answer comes from the semantic cache
+    cached_similarity: float | None = None
+    session_id: str | None = None
+
+
+class SessionResponse(BaseModel):
+    session_id: str
+    turns: list[dict]
+
+
+class BatchQueryRequest(BaseModel):
+  items: list[QueryRequest] = Field(max_length=BATCH_MAX_ITEMS)
+  # Maximum number of items processed at the same time, capped by BATCH_CONCURRENCY
+  concurrency: int | None = Field(default=None, ge=1)
+
+
+class BatchQueryItemResult(BaseModel):
+    answer: str | None = None
+    cached_similarity: float | None = None
+    session_id: str | None = None
+    error: str | None = None
+
+
+class BatchQueryResponse(BaseModel):
+    results: list[BatchQueryItemResult]
+
+async def refine_and_embed_query(conversation: ConversationContext, user_query: str, embed=None) -> tuple[str, list[float]]:
+  """
+  Refine the user query with the LLM and embed the refined query using Pinecone.
+  Returns the refined query and its embedding.
+  If the deadline of the request is too close or OpenAI is unavailable, the query is embedded as it is.
+  `embed` replaces `pinecone_service.get_embedding_async`, e.g. to batch the embeddings of many queries.
+  """
+  embed = embed or pinecone_service.get_embedding_async
+  refined_query = user_query
+  if has_time_for("refinement"):
+    prompt_builder = build_prompt_for_query_refinement.__name__
+    try:
+      refined_query = await openai_service.get_chat_completion_async(
+        build_prompt_for_query_refinement(conversation.render_for(prompt_builder), user_query),
+        prompt_builder=prompt_builder
+      )
+    except UpstreamUnavailable:
+      record_degradation("skip_refinement")
+  else:
+    record_degradation("skip_refinement")
+  return refined_query, await embed(refined_query)
+
+
+async def search_documents(query_vector: list[float], query_text: str) -> list[dict]:
+  """
+  Fetches the top RETRIEVAL_TOP_K documents. With the reranker, more candidates are fetched
+  with their vectors and the final documents are picked locally (see services/rerank.py).
+  """
+  if reranker is None:
+    return await vector_store.get_similar_documents_async(query_vector, top_k=RETRIEVAL_TOP_K)
+  candidates = await vector_store.get_similar_documents_async(
+    query_vector, top_k=max(reranker.candidates, RETRIEVAL_TOP_K), include_values=True
+  )
+  return reranker.rerank(query_vector, query_text, candidates, RETRIEVAL_TOP_K)
+
+
+async def retrieve_with_refinement(conversation: ConversationContext, user_query: str, embed=None) -> list[dict]:
+  """
+  Refines and embeds the query, and fetches the documents.
+  """
+  refined_query, query_vector = await refine_and_embed_query(conversation, user_query, embed)
+  return await search_documents(query_vector, refined_query)
+
+
+async def gather_or_cancel(*coroutines) -> list:
+  """
+  Like `asyncio.gather`, but when one of the coroutines fails, the others are cancelled
+  instead of running on in the background.
+  """
+  tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+
+
+class SpeculativeRetrieval:
+  """
+  Refines, embeds and fetches the documents for a query in a background task,
+  before knowing if the documents will be needed.
+  Keeps count of the Pinecone queries whose results end up being discarded.
+  The documents are only added to the session when `result` is used, so discarded ones are never reused.
+  """
+  def __init__(self, conversation: ConversationContext, user_query: str, embed=None, session: Session | None = None):
+    self.query_sent = False
+    self.session = session
+    self.task = asyncio.create_task(self._retrieve(conversation, user_query, embed))
+
+  async def _retrieve(self, conversation: ConversationContext, user_query: str, embed=None) -> tuple[list[float], list[dict], bool]:
+    """Returns the query vector, the documents and whether they were fetched (rather than found in the session)."""
+    refined_query, query_vector = await refine_and_embed_query(conversation, user_query, embed)
+    if self.session is not None:
+      documents = self.session.get_documents(query_vector)
+      if documents is not None:
+        return query_vector, documents, False
+    self.query_sent = True
+    retrieval_stats["speculative_queries"] += 1
+    return query_vector, await search_documents(query_vector, refined_query), True
+
+  async def result(self) -> list[dict]:
+    query_vector, documents, fetched = await self.task
+    if fetched and self.session is not None:
+      self.session.add_documents(query_vector, documents, session_store.max_turns)
+    return documents
+
+  def discard(self):
+    self.task.cancel()
+    # The task may have failed before being cancelled: its exception is not needed, mark it as retrieved
+    self.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    if self.query_sent:
+      retrieval_stats["wasted_speculative_queries"] += 1
+
+
+@rag_router.get("/stats")
+async def get_stats():
+  """
+  Returns the counters collected by the RAG pipeline.
+  """
+  stats = {"retrieval": retrieval_stats}
+  if pinecone_service.embedding_cache is not None:
+    stats["embedding_cache"] = pinecone_service.embedding_cache.get_stats()
+  if semantic_cache is not None:
+    stats["semantic_cache"] = semantic_cache.get_stats()
+  if necessity_checker is not None:
+    stats["necessity"] = necessity_checker.get_stats()
+  if refinement_bypass is not None:
+    stats["refinement_bypass"] = refinement_bypass.get_stats()
+  if conversation_summarizer is not None:
+    stats["conversation_summary"] = conversation_summarizer.get_stats()
+  if session_store is not None:
+    stats["sessions"] = session_store.get_stats()
+  stats["upstreams"] = {limiter.name: limiter.get_stats() for limiter in limiters}
+  stats["single_flight"] = {
+    flights.name: flights.get_stats()
+    for flights in (openai_service.single_flight, pinecone_service.embedding_flights, pinecone_service.retrieval_flights)
+  }
+  return stats
+
+
+@dataclass
+class PreparedQuery:
+  """
+  Everything that is known about a query before its final completion.
+  `answer` and `cached_similarity` are only set when the answer comes from the semantic cache.
+  """
+  prompt: str | None = None
+  prompt_builder: str | None = None
+  documents: list[dict] | None = None
+  raw_query_vector: list[float] | None = None
+  answer: str | None = None
+  cached_similarity: float | None = None
+
+
+async def open_session(session_id: str | None, user_context: list[dict]) -> Session | None:
+  """
+  Loads the session of a query request, if it has a `session_id`.
+  """
+  if session_id is None:
+    return None
+  if user_context:
+    raise HTTPException(status_code=400, detail="Send either a session_id or a context, not both.")
+  session = await get_session_store().get(session_id)
+  if session is None:
+    raise HTTPException(status_code=404, detail="Session not found or expired.")
+  return session
+
+
+async def retrieve_documents(query_vector: list[float], query_text: str, session: Session | None = None) -> list[dict]:
+  """
+  Fetches the documents (see `search_documents`), reusing the ones retrieved with the same query vector in the session.
+  """
+  if session is not None:
+    documents = session.get_documents(query_vector)
+    if documents is not None:
+      return documents
+  documents = await search_documents(query_vector, query_text)
+  if session is not None:
+    session.add_documents(query_vector, documents, session_store.max_turns)
+  return documents
+
+
+async def retrieve_if_needed(conversation: ConversationContext, user_query: str, user_context: list[dict], embed, session: Session | None = None) -> list[dict] | None:
+  """
+  Checks if a follow-up turn needs new documents and retrieves them.
+  Returns None if no new documents are needed.
+  """
+  if necessity_checker is not None:
+    # Decide locally by comparing the refined query with the previous turns (the LLM only decides ambiguous cases).
+    # The previous turns are embedded while the query is refined.
+    (refined_query, query_vector), context_vectors = await gather_or_cancel(
+      refine_and_embed_query(conversation, user_query, embed),
+      necessity_checker.embed_context(user_context)
+    )
+    if not await necessity_checker.needs_new_documents(conversation, user_query, query_vector, context_vectors):
+      return None
+    return await retrieve_documents(query_vector, refined_query, session)
+
+  if SPECULATIVE_RETRIEVAL:
+    # The retrieval starts right away and runs concurrently with the necessity check.
+    # Its result is only used if the check says that new documents are necessary.
+    retrieval = SpeculativeRetrieval(conversation, user_query, embed, session)
+    try:
+      needs_new_documents = await check_necessity_with_llm(conversation, user_query)
+    except BaseException:
+      retrieval.discard()
+      raise
+    if not needs_new_documents:
+      retrieval.discard()
+      return None
+    return await retrieval.result()
+
+  # The refinement and the necessity check only depend on the context and the query, so they run concurrently.
+  (refined_query, query_vector), needs_new_documents = await gather_or_cancel(
+    refine_and_embed_query(conversation, user_query, embed),
+    check_necessity_with_llm(conversation, user_query)
+  )
+  if not needs_new_documents:
+    return None
+  return await retrieve_documents(query_vector, refined_query, session)
+
+
+async def prepare_query(user_query: str, user_context: list[dict], embed=None, session: Session | None = None) -> PreparedQuery:
+  """
+  Runs the steps of the RAG pipeline that come before the final completion:
+  refines and embeds the query, retrieves the documents if they are needed, and builds the final prompt.
+  `embed` replaces `pinecone_service.get_embedding_async` (see `refine_and_embed_query`).
+  With a `session`, the documents of the queries already seen in the session are reused.
+  """
+  prepared = PreparedQuery()
+  embed = embed or pinecone_service.get_embedding_async
+  # The conversation is rendered once and shared by the refinement, necessity and answer prompts
+  conversation = ConversationContext(user_context, conversation_summarizer)
+
+  if len(user_context) == 0:
+    BRANCHES.labels("first_turn").inc()
+    # Queries that are already clear search phrases skip the refinement and are embedded as they are.
+    # Otherwise the refinement starts right away, so it runs while the raw query is embedded for the semantic cache.
+    bypass = refinement_bypass is not None and refinement_bypass.should_bypass(user_context, user_query)
+    refinement = None if bypass else asyncio.ensure_future(refine_and_embed_query(conversation, user_query, embed))
+    try:
+      # 2.0) If it is the first query and a semantically equivalent one was already answered, reuse its answer.
+      # The raw query is embedded (the model is multilingual), so a cache hit costs no LLM calls to wait for.
+      if semantic_cache is not None:
+        prepared.raw_query_vector = await embed(user_query)
+        cached = semantic_cache.lookup(prepared.raw_query_vector)
+        if cached is not None:
+          entry, prepared.cached_similarity = cached
+          prepared.answer = entry["answer"]
+          BRANCHES.labels("semantic_cache_hit").inc()
+          return prepared
+
+      # 2.1) Otherwise, embed the refined query and fetch the documents from Pinecone and send the prompt without user_context.
+      if bypass:
+        query_vector = prepared.raw_query_vector or await embed(user_query)
+        prepared.documents = await retrieve_documents(query_vector, user_query, session)
+        refinement_bypass.compare_in_background(prepared.documents, retrieve_with_refinement(conversation, user_query, embed))
+      else:
+        refined_query, query_vector = await refinement
+        prepared.documents = await retrieve_documents(query_vector, refined_query, session)
+    finally:
+      # On a cache hit or an error, the refinement is not needed anymore (and its error, if any, is ignored)
+      if refinement is not None:
+        refinement.cancel()
+        refinement.add_done_callback(lambda task: task.cancelled() or task.exception())
+    prepared.prompt = build_prompt_for_initial_message(user_query, prepared.documents)
+    prepared.prompt_builder = build_prompt_for_initial_message.__name__
+  else:
+    # 2.2) If it is not the first query, check if it is necessary to retrieve new documents.
+    # When the deadline is too close or an upstream is unavailable, the answer is based on the conversation alone.
+    if has_time_for("necessity"):
+      try:
+        prepared.documents = await retrieve_if_needed(conversation, user_query, user_context, embed, session)
+      except UpstreamUnavailable:
+        record_degradation("no_new_documents")
+    else:
+      record_degradation("no_new_documents")
+    needs_new_documents = prepared.documents is not None
+
+    if needs_new_documents:
+      # 2.2.1) If new documents are necessary, send the prompt with the new documents and user_context
+      BRANCHES.labels("retrieve").inc()
+      prepared.prompt_builder = build_prompt_for_intermediate_message_with_new_docs.__name__
+      prepared.prompt = build_prompt_for_intermediate_message_with_new_docs(
+        conversation.render_for(prepared.prompt_builder), user_query, prepared.documents
+      )
+    else:
+      # 2.2.2) If new documents are not necessary, send the prompt with user_context
+      BRANCHES.labels("no_retrieve").inc()
+      prepared.prompt_builder = build_prompt_for_intermediate_message_without_new_docs.__name__
+      prepared.prompt = build_prompt_for_intermediate_message_without_new_docs(
+        conversation.render_for(prepared.prompt_builder), user_query
+      )
+
+  return prepared
+
+
+async def remember_answer(prepared: PreparedQuery, user_query: str, user_context: list[dict], answer: str, session: Session | None = None):
+  """
+  Stores the answer to a first-turn query in the semantic cache, and the turn in the session (if any).
+  """
+  if len(user_context) == 0 and semantic_cache is not None and prepared.answer is None:
+    semantic_cache.add(prepared.raw_query_vector, [document["id"] for document in prepared.documents], answer)
+  if session is not None:
+    await session_store.add_turn(session, user_query, answer, prepared.documents)
+
 
 @rag_router.post("/", response_model=QueryResponse)
-def rag_query(payload: QueryRequest):
+async def rag_query(payload: QueryRequest):
   """
   Receives a JSON payload with 'query' and 'context'.
   First, embed the user query using Pinecone, in order to find similar documents in the documents index.
-  Then, build a prompt that includes the user query, the top-3 relevant documents to the query, and the user context.
+  Then, build a prompt that includes the user query, the most relevant documents to the query, and the user context.
   Finally, use OpenAI ChatCompletion to generate a response to the user query.
   
   Example:
@@ -36,31 +379,162 @@ def rag_query(payload: QueryRequest):
       ]
     }
   """
-  user_query = payload.query
-  user_context = payload.context
+  admit_request()
+  return await answer_query(payload.query, payload.context, session_id=payload.session_id)
 
-  # 1) Embed the user query using Pinecone
-  refined_query = openai_service.get_chat_completion(build_prompt_for_query_refinement(user_context,user_query))
-  query_vector = pinecone_service.get_embedding(refined_query)
-  
-  # 2.1) If it is the first query, fetch the top-3 documents from Pinecone sen the prompt without user_context
-  if len(user_context) == 0:
-    top_contexts = pinecone_service.get_similar_documents(query_vector, top_k=3)
-    prompt = build_prompt_for_initial_message(user_query, top_contexts)
-  else:
-    # 2.2) If it is not the first query, check if it is necessary to retrieve new documents
-    prompt = build_prompt_to_check_necessity_of_retrieving_documents(user_context, user_query)
-    raw_answer = openai_service.get_chat_completion(prompt)
-    answer_clean = raw_answer.strip().lower()
-    if "true" in answer_clean:
-      # 2.2.1) If new documents are necessary, fetch the top-3 documents from Pinecone and send the prompt with user_context
-      top_contexts = pinecone_service.get_similar_documents(query_vector, top_k=3)
-      prompt = build_prompt_for_intermediate_message_with_new_docs(user_context, user_query, top_contexts)
-    else:
-      # 2.2.2) If new documents are not necessary, send the prompt with user_context
-      prompt = build_prompt_for_intermediate_message_without_new_docs(user_context, user_query)
+
+async def answer_query(user_query: str, user_context: list[dict], embed=None, session_id: str | None = None) -> QueryResponse:
+  """
+  Runs the whole RAG pipeline for a query (see `rag_query`), within the deadline of the request.
+  With a `session_id`, the context is the conversation stored in the session, and the new turn is added to it.
+  """
+  start_deadline()
+  session = await open_session(session_id, user_context)
+  if session is not None:
+    user_context = session.context
+
+  prepared = await prepare_query(user_query, user_context, embed, session)
+  if prepared.answer is not None:
+    await remember_answer(prepared, user_query, user_context, prepared.answer, session)
+    return QueryResponse(answer=prepared.answer, cached_similarity=prepared.cached_similarity, session_id=session_id)
   
   # 3) Use OpenAI ChatCompletion to get final answer
-  answer = openai_service.get_chat_completion(prompt)
+  answer = await openai_service.get_chat_completion_async(prepared.prompt, prompt_builder=prepared.prompt_builder)
+  await remember_answer(prepared, user_query, user_context, answer, session)
   
-  return QueryResponse(answer=answer)
+  return QueryResponse(answer=answer, session_id=session_id)
+
+
+@rag_router.post("/batch", response_model=BatchQueryResponse)
+async def rag_query_batch(payload: BatchQueryRequest):
+  """
+  Answers many queries in one request, e.g. for offline evaluations.
+  The queries are processed with at most `concurrency` of them in flight, and the embeddings
+  of the queries that are processed at the same time are sent in batched embed calls.
+  The results are returned in the same order as the items, with an `error` for the items that failed.
+
+  Example:
+    POST /query/batch
+    {
+    "items": [
+      {"query": "Active learning in NLP", "context": []},
+      {"query": "Papers on machine translation evaluation", "context": []}
+      ],
+    "concurrency": 8
+    }
+  """
+  admit_request()
+  concurrency = min(payload.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+  semaphore = asyncio.Semaphore(concurrency)
+  batcher = EmbeddingBatcher(pinecone_service)
+
+  async def answer_item(item: QueryRequest) -> BatchQueryItemResult:
+    async with semaphore:
+      try:
+        response = await answer_query(item.query, item.context, embed=batcher.get_embedding, session_id=item.session_id)
+      except HTTPException as e:
+        return BatchQueryItemResult(error=str(e.detail))
+      except Exception as e:
+        return BatchQueryItemResult(error=str(e))
+      return BatchQueryItemResult(
+        answer=response.answer, cached_similarity=response.cached_similarity, session_id=response.session_id
+      )
+
+  results = await asyncio.gather(*(answer_item(item) for item in payload.items))
+  return BatchQueryResponse(results=results)
+
+
+def format_event(event: str, data) -> str:
+  """
+  Formats a Server-Sent Event with a JSON payload.
+  """
+  return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@rag_router.post("/stream")
+async def rag_query_stream(payload: QueryRequest):
+  """
+  Same as POST /query, but the answer is sent as Server-Sent Events while the model generates it:
+  - `documents`: the retrieved documents (id, title, url, year and score), as soon as they are available.
+    Not sent if no new documents were retrieved.
+  - `token`: a piece of the answer, `{"text": "..."}`.
+  - `done`: the answer is complete, `{"cached_similarity": ..., "session_id": ...}`.
+  - `error`: the completion failed after the stream started, `{"detail": "..."}`.
+  """
+  admit_request()
+  start_deadline()
+  user_query = payload.query
+  user_context = payload.context
+  session = await open_session(payload.session_id, user_context)
+  if session is not None:
+    user_context = session.context
+
+  # Errors before the final completion are returned as regular HTTP errors
+  prepared = await prepare_query(user_query, user_context, session=session)
+
+  async def events():
+    if prepared.documents is not None:
+      yield format_event("documents", [
+        {key: document.get(key) for key in ("id", "title", "url", "year", "score")} for document in prepared.documents
+      ])
+
+    if prepared.answer is not None:
+      await remember_answer(prepared, user_query, user_context, prepared.answer, session)
+      yield format_event("token", {"text": prepared.answer})
+      yield format_event("done", {"cached_similarity": prepared.cached_similarity, "session_id": payload.session_id})
+      return
+
+    parts = []
+    try:
+      async for text in openai_service.stream_chat_completion(prepared.prompt, prompt_builder=prepared.prompt_builder):
+        parts.append(text)
+        yield format_event("token", {"text": text})
+    except UpstreamUnavailable as e:
+      yield format_event("error", {"detail": str(e)})
+      return
+    except Exception:
+      # The client is told that the answer is incomplete, and the error is still raised to be logged by the server
+      yield format_event("error", {"detail": "The answer could not be completed."})
+      raise
+
+    await remember_answer(prepared, user_query, user_context, "".join(parts).strip(), session)
+    yield format_event("done", {"cached_similarity": None, "session_id": payload.session_id})
+
+  return StreamingResponse(
+    events(),
+    media_type="text/event-stream",
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+  )
+
+
+def get_session_store():
+  if session_store is None:
+    raise HTTPException(status_code=400, detail="Sessions are disabled (SESSION_STORE=none).")
+  return session_store
+
+
+@rag_router.post("/sessions", response_model=SessionResponse)
+async def create_session():
+  """
+  Starts a server-side session. Queries sent with its `session_id` (and no `context`) continue the
+  conversation stored in the session, so the client does not have to resend it on every turn.
+  """
+  session = await get_session_store().create()
+  return SessionResponse(session_id=session.id, turns=session.turns)
+
+
+@rag_router.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str):
+  """
+  Returns the turns of a session, with the ids of the documents retrieved in each of them.
+  """
+  session = await get_session_store().get(session_id)
+  if session is None:
+    raise HTTPException(status_code=404, detail="Session not found or expired.")
+  return SessionResponse(session_id=session.id, turns=session.turns)
+
+
+@rag_router.delete("/sessions/{session_id}", status_code=204)
+async def delete_session(session_id: str):
+  if not await get_session_store().delete(session_id):
+    raise HTTPException(status_code=404, detail="Session not found or expired.")
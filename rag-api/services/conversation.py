@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from functools import cache
+
+from config import (
+    CONTEXT_SUMMARY, CONTEXT_SUMMARY_CACHE_SIZE, CONTEXT_SUMMARY_MAX_TOKENS,
+    CONTEXT_TOKEN_BUDGET_ANSWER, CONTEXT_TOKEN_BUDGET_NECESSITY, CONTEXT_TOKEN_BUDGET_REFINEMENT
+)
+from services.metrics import PROMPT_STAGES, request_timings
+from services.openai import openai_service
+from services.scheduling import request_deadline
+from services.prompting import build_prompt_for_conversation_summary, format_turn
+
+# Token budget of the conversation history in the prompts of each stage
+STAGE_TOKEN_BUDGETS = {
+    "refinement": CONTEXT_TOKEN_BUDGET_REFINEMENT,
+    "necessity": CONTEXT_TOKEN_BUDGET_NECESSITY,
+    "answer": CONTEXT_TOKEN_BUDGET_ANSWER,
+}
+# Characters per token used to estimate the token counts if the tokenizer cannot be loaded
+CHARACTERS_PER_TOKEN = 4
+SUMMARY_HEADER = "Summary of the earlier conversation: "
+TURN_SEPARATOR = "\n\n"
+
+
+@cache
+def get_encoding():
+    """
+    The tokenizer of gpt-4o-mini, loaded on first use (or by the warm-up, see services/warm_up.py).
+    tiktoken downloads it the first time (set TIKTOKEN_CACHE_DIR to ship it with the deployment),
+    so the token counts fall back to an estimate if it cannot be loaded.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + CHARACTERS_PER_TOKEN - 1) // CHARACTERS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keeps the first `max_tokens` tokens of the text."""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARACTERS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def prefix_keys(turns: list[str]) -> list[str]:
+    """Key of every prefix of the conversation: keys[k] identifies turns[:k + 1]."""
+    keys = []
+    digest = hashlib.sha256()
+    for turn in turns:
+        digest.update(turn.encode())
+        digest.update(b"\x1f")
+        keys.append(digest.copy().hexdigest())
+    return keys
+
+
+class ConversationSummarizer:
+    """
+    Keeps rolling summaries of the older turns of the conversations, keyed by the turns they cover.
+
+    The API is stateless (the client sends the whole conversation every time), so the summary of
+    turns 1..k is found again on the next request of the conversation by hashing its first k turns.
+    When more turns leave the window of recent messages, the longest cached summary is extended
+    with only the new turns, in the background, so the summary never adds latency to a request.
+    At most `max_input_tokens` of new turns are summarized at once: if a long conversation is seen
+    for the first time, only its most recent older turns make it into the summary.
+    """
+    def __init__(self, capacity: int, max_tokens: int, max_input_tokens: int):
+        self.capacity = capacity
+        self.max_tokens = max_tokens
+        self.max_input_tokens = max_input_tokens
+        # Prefix key -> summary, in LRU order
+        self.summaries = OrderedDict()
+        # Prefix keys whose summary is being generated, and references to their tasks
+        self.pending = set()
+        self.tasks = set()
+        self.stats = {"hits": 0, "partial_hits": 0, "misses": 0, "updates": 0, "errors": 0}
+
+    def lookup(self, keys: list[str], count: int) -> tuple[str, int]:
+        """Longest cached summary of the first `count` turns, and the number of turns it covers."""
+        for covered in range(count, 0, -1):
+            summary = self.summaries.get(keys[covered - 1])
+            if summary is not None:
+                self.summaries.move_to_end(keys[covered - 1])
+                self.stats["hits" if covered == count else "partial_hits"] += 1
+                return summary, covered
+        self.stats["misses"] += 1
+        return "", 0
+
+    def update_in_background(self, turns: list[str], token_counts: list[int], keys: list[str], count: int, summary: str, covered: int):
+        """Extends `summary` (of the first `covered` turns) to the first `count` turns."""
+        key = keys[count - 1]
+        if key in self.pending:
+            return
+        self.pending.add(key)
+
+        new_turns = []
+        remaining = self.max_input_tokens
+        for idx in range(count - 1, covered - 1, -1):
+            if token_counts[idx] > remaining:
+                if not new_turns:
+                    new_turns.append(truncate_to_tokens(turns[idx], remaining))
+                break
+            new_turns.insert(0, turns[idx])
+            remaining -= token_counts[idx]
+
+        task = asyncio.create_task(self._update(new_turns, key, summary))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _update(self, new_turns: list[str], key: str, summary: str):
+        # The summary is not part of the request that started it, so it is kept out of its Server-Timing header and deadline
+        request_timings.set(None)
+        request_deadline.set(None)
+        prompt = build_prompt_for_conversation_summary(
+            summary, TURN_SEPARATOR.join(new_turns), max_words=int(self.max_tokens * 0.75)
+        )
+        try:
+            updated = await openai_service.get_chat_completion_async(
+                prompt, prompt_builder=build_prompt_for_conversation_summary.__name__
+            )
+        except Exception:
+            self.stats["errors"] += 1
+            return
+        finally:
+            self.pending.discard(key)
+        self.summaries[key] = truncate_to_tokens(updated, self.max_tokens)
+        self.summaries.move_to_end(key)
+        while len(self.summaries) > self.capacity:
+            self.summaries.popitem(last=False)
+        self.stats["updates"] += 1
+
+    def get_stats(self) -> dict:
+        encoding = get_encoding()
+        return {**self.stats, "size": len(self.summaries), "tokenizer": encoding.name if encoding else "estimate"}
+
+
+conversation_summarizer = None
+if CONTEXT_SUMMARY and CONTEXT_SUMMARY_CACHE_SIZE > 0:
+    conversation_summarizer = ConversationSummarizer(
+        capacity=CONTEXT_SUMMARY_CACHE_SIZE,
+        max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+        max_input_tokens=CONTEXT_TOKEN_BUDGET_ANSWER
+    )
+
+
+class ConversationContext:
+    """
+    The user context of a request, rendered once and shared by all its prompts.
+
+    Every turn is formatted and counted in tokens once. Each prompt builder gets the most recent turns
+    that fit in the token budget of its stage; the turns that do not fit in the largest budget are
+    replaced by the rolling summary of `conversation_summarizer`, so the prompts stay bounded however
+    long the conversation grows.
+    """
+    def __init__(self, user_context: list[dict], summarizer: ConversationSummarizer | None = None):
+        self.turns = user_context
+        self.rendered = [format_turn(idx, turn) for idx, turn in enumerate(user_context, start=1)]
+        self.token_counts = [count_tokens(turn) for turn in self.rendered]
+        self.views = {}
+
+        # The recent turns that fit in the largest budget, always at least the last one
+        self.window_start = self._first_turn_within(max(STAGE_TOKEN_BUDGETS.values()))
+        self.summary = ""
+        if summarizer is not None and self.window_start > 0:
+            keys = prefix_keys(self.rendered)
+            self.summary, covered = summarizer.lookup(keys, self.window_start)
+            if covered < self.window_start:
+                summarizer.update_in_background(
+                    self.rendered, self.token_counts, keys, self.window_start, self.summary, covered
+                )
+
+    def _first_turn_within(self, budget: int) -> int:
+        used = 0
+        for idx in range(len(self.rendered) - 1, -1, -1):
+            used += self.token_counts[idx]
+            if used > budget:
+                return min(idx + 1, len(self.rendered) - 1)
+        return 0
+
+    def render(self, budget: int) -> str:
+        """
+        The summary of the older turns (if any) followed by the most recent turns, within `budget` tokens.
+        If even the last turn does not fit, it is truncated.
+        """
+        if budget in self.views:
+            return self.views[budget]
+        if not self.rendered:
+            return ""
+
+        parts = []
+        remaining = budget
+        if self.summary:
+            summary = truncate_to_tokens(SUMMARY_HEADER + self.summary, remaining // 2)
+            parts.append(summary)
+            remaining -= count_tokens(summary)
+
+        start = max(self._first_turn_within(remaining), self.window_start if self.summary else 0)
+        recent = self.rendered[start:]
+        if self.token_counts[-1] > remaining:
+            recent = [truncate_to_tokens(recent[-1], remaining)]
+        self.views[budget] = TURN_SEPARATOR.join(parts + recent)
+        return self.views[budget]
+
+    def render_for(self, prompt_builder: str) -> str:
+        """The conversation within the token budget of the stage of `prompt_builder` (see services/metrics.py)."""
+        return self.render(STAGE_TOKEN_BUDGETS[PROMPT_STAGES[prompt_builder]])
@@ -0,0 +1,106 @@
+import argparse
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Fields of the ACL parquet returned with each retrieved document (besides its id and score), and their value when missing
+DOCUMENT_DEFAULTS = {"title": "", "abstract": "", "url": None, "year": None}
+DOCUMENT_FIELDS = list(DOCUMENT_DEFAULTS)
+# Numeric fields keep their numeric type, so they are returned as numbers
+DOCUMENT_TYPES = {"title": pa.string(), "abstract": pa.string(), "url": pa.string(), "year": pa.int64()}
+DOCUMENT_SCHEMA = pa.schema([("id", pa.string())] + [(name, DOCUMENT_TYPES[name]) for name in DOCUMENT_FIELDS])
+
+
+def cast_field(column, name: str):
+    """
+    Casts a column to the type of the document field `name`.
+    Values of a numeric field that are not integers (e.g. "" or "n.d.") become null instead of failing the cast.
+    """
+    field_type = DOCUMENT_TYPES[name]
+    if pa.types.is_integer(field_type) and not pa.types.is_integer(column.type):
+        text = pc.utf8_trim_whitespace(column.cast(pa.string()))
+        column = pc.if_else(pc.match_substring_regex(text, r"^[+-]?\d+$"), text, pa.scalar(None, pa.string()))
+    return column.cast(field_type)
+
+
+def to_document_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """Select and cast the document fields of a record batch of the ACL parquet (missing fields are null)."""
+    columns = [batch.column("acl_id").cast(pa.string())] + [
+        cast_field(batch.column(name), name) if name in batch.schema.names else pa.nulls(batch.num_rows, DOCUMENT_TYPES[name])
+        for name in DOCUMENT_FIELDS
+    ]
+    return pa.record_batch(columns, schema=DOCUMENT_SCHEMA)
+
+
+class DocumentStore:
+    """
+    Metadata of the ACL documents, memory-mapped from an Arrow IPC file built from the parquet
+    (see `build_document_store`), so retrieval only needs ids and scores from the vector index.
+
+    Documents are looked up by row (the local vector index shares its rows) or by id, through
+    an id -> row index built when the store is opened.
+    """
+    def __init__(self, path: str):
+        self.table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        self.ids = self.table.column("id")
+        # Files built before a field was added lack its column, and the older ones stored every field as a string
+        self.columns = {
+            name: cast_field(self.table.column(name), name)
+            for name in DOCUMENT_FIELDS if name in self.table.column_names
+        }
+        self.rows = {document_id: row for row, document_id in enumerate(self.ids.to_pylist())}
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def get_documents(self, rows: list[int], scores: list[float]) -> list[dict]:
+        """The documents of the given rows, with their scores."""
+        # Scalar access is much faster than `Table.take` on the chunked, memory-mapped columns
+        results = []
+        for row, score in zip(rows, scores):
+            document = {"id": self.ids[row].as_py()}
+            for name in DOCUMENT_FIELDS:
+                value = self.columns[name][row].as_py() if name in self.columns else None
+                document[name] = DOCUMENT_DEFAULTS[name] if value is None else value
+            document["score"] = float(score)
+            results.append(document)
+        return results
+
+    def get_documents_by_id(self, ids: list[str], scores: list[float]) -> list[dict]:
+        """
+        The documents with the given ids, with their scores.
+        Ids missing from the store are returned without metadata.
+        """
+        results = []
+        for document_id, score in zip(ids, scores):
+            row = self.rows.get(document_id)
+            if row is None:
+                results.append({"id": document_id, **DOCUMENT_DEFAULTS, "score": float(score)})
+            else:
+                results.extend(self.get_documents([row], [score]))
+        return results
+
+
+def build_document_store(parquet_path: str, output_path: str, batch_size: int = 4096):
+    """
+    Write the document fields of the ACL parquet to an Arrow IPC file, streaming it in record batches.
+    """
+    parquet = pq.ParquetFile(parquet_path)
+    columns = [name for name in ["acl_id"] + DOCUMENT_FIELDS if name in parquet.schema_arrow.names]
+    written = 0
+    with pa.OSFile(output_path, "wb") as sink, pa.ipc.new_file(sink, DOCUMENT_SCHEMA) as writer:
+        for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+            writer.write_batch(to_document_batch(batch))
+            written += batch.num_rows
+            print(f"Wrote {written}/{parquet.metadata.num_rows} documents")
+
+
+if __name__ == "__main__":
+    # Example: python -m services.document_store acl-publication-info.74k.parquet documents.arrow
+    parser = argparse.ArgumentParser(description="Build the local document store from the ACL parquet.")
+    parser.add_argument("parquet_path")
+    parser.add_argument("output_path")
+    args = parser.parse_args()
+
+    build_document_store(args.parquet_path, args.output_path)
@@ -0,0 +1,112 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# The expired rows of the SQLite tier are deleted every this many writes
+PRUNE_INTERVAL = 1000
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase the text and collapse its whitespace, so trivially different queries share a cache entry."""
+    return " ".join(text.split()).lower()
+
+
+class EmbeddingCache:
+    """
+    Memoizes embeddings by (model, input_type, normalized text).
+
+    Keeps a bounded in-memory LRU with a TTL and, if `path` is given, a SQLite tier
+    that survives restarts and is shared by all the workers on the same machine.
+    The SQLite tier is read and written in a thread, so it never blocks the event loop.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 86400, path: str | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.writes = 0
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._prune_sync()
+
+    def _make_key(self, model: str, input_type: str, text: str) -> str:
+        return f"{model}\x1f{input_type}\x1f{normalize_text(text)}"
+
+    async def get(self, model: str, input_type: str, text: str) -> list[float] | None:
+        """Returns the cached embedding, or None if it is missing or expired."""
+        key = self._make_key(model, input_type, text)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                vector, created_at = entry
+                if now - created_at < self.ttl:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return vector
+                del self.entries[key]
+
+        if self.db is not None:
+            row = await asyncio.to_thread(self._read_sync, key)
+            if row is not None and now - row[1] < self.ttl:
+                vector = array("f", row[0]).tolist()
+                with self.lock:
+                    self._store(key, vector, row[1])
+                    self.stats["disk_hits"] += 1
+                return vector
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    async def set(self, model: str, input_type: str, text: str, vector: list[float]):
+        """Stores the embedding in memory and, if enabled, on disk."""
+        key = self._make_key(model, input_type, text)
+        now = time.time()
+        with self.lock:
+            self._store(key, list(vector), now)
+        if self.db is not None:
+            await asyncio.to_thread(self._write_sync, key, array("f", vector).tobytes(), now)
+
+    def _read_sync(self, key: str) -> tuple | None:
+        with self.db_lock:
+            return self.db.execute("SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+
+    def _write_sync(self, key: str, vector: bytes, created_at: float):
+        with self.db_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                (key, vector, created_at)
+            )
+            self.db.commit()
+            self.writes += 1
+            if self.writes % PRUNE_INTERVAL == 0:
+                self._prune_sync()
+
+    def _prune_sync(self):
+        """Deletes the expired rows of the SQLite tier."""
+        self.db.execute("DELETE FROM embeddings WHERE created_at < ?", (time.time() - self.ttl,))
+        self.db.commit()
+
+    def _store(self, key: str, vector: list[float], created_at: float):
+        self.entries[key] = (vector, created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {**self.stats, "size": len(self.entries), "max_size": self.max_size}
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from services.document_store import DOCUMENT_FIELDS, DOCUMENT_SCHEMA, DocumentStore, to_document_batch
+from services.metrics import stage
+from services.vector_store import VectorStore
+
+EMBEDDING_DIMENSION = 1024
+# Rows scored at once, so quantized matrices are never fully converted to float32 in memory
+BLOCK_SIZE = 8192
+
+EMBEDDINGS_FILE = "embeddings.npy"
+SCALES_FILE = "scales.npy"
+DOCUMENTS_FILE = "documents.arrow"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+IVF_ROWS_FILE = "ivf_rows.npy"
+
+
+def decode_embeddings(column: pa.Array) -> np.ndarray:
+    """
+    Decode a column of embeddings into a float32 matrix in one pass.
+    Accepts JSON-encoded strings ("[0.1, 0.2, ...]", as stored in the ACL parquet) or list columns.
+    """
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        return column.values.to_numpy(zero_copy_only=False).astype(np.float32).reshape(len(column), -1)
+    joined = ",".join(embedding.strip()[1:-1] for embedding in column.to_pylist())
+    return np.fromstring(joined, sep=",", dtype=np.float32).reshape(len(column), -1)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize each row, so the dot product of two rows is their cosine similarity."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process document index built from the ACL parquet (see `build_local_index`).
+
+    The L2-normalized embeddings are memory-mapped from a contiguous float32, float16 or int8
+    matrix (int8 rows have a float32 scale each), and the top-k documents are found by
+    vectorized cosine similarity and `argpartition`. If the index was built with an IVF
+    partition, only the `nprobe` clusters closest to the query are scored.
+    """
+    def __init__(self, path: str, nprobe: int = 8):
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+        scales_path = os.path.join(path, SCALES_FILE)
+        self.scales = np.load(scales_path, mmap_mode="r") if os.path.exists(scales_path) else None
+        self.documents = DocumentStore(os.path.join(path, DOCUMENTS_FILE))
+
+        self.nprobe = nprobe
+        self.centroids = None
+        if os.path.exists(os.path.join(path, IVF_CENTROIDS_FILE)):
+            self.centroids = np.load(os.path.join(path, IVF_CENTROIDS_FILE))
+            self.list_offsets = np.load(os.path.join(path, IVF_OFFSETS_FILE))
+            self.list_rows = np.load(os.path.join(path, IVF_ROWS_FILE), mmap_mode="r")
+
+    def load_rows(self, rows) -> np.ndarray:
+        """The float32 embeddings of the given rows (a slice or an array of row numbers)."""
+        vectors = np.asarray(self.embeddings[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def _score(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """Cosine similarity between the normalized query and the given rows (all of them if None)."""
+        count = len(self.embeddings) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, count)
+            block_rows = slice(start, end) if rows is None else rows[start:end]
+            block = np.asarray(self.embeddings[block_rows], dtype=np.float32)
+            scores[start:end] = block @ query
+            if self.scales is not None:
+                scores[start:end] *= self.scales[block_rows]
+        return scores
+
+    def _candidate_rows(self, query: np.ndarray) -> np.ndarray | None:
+        """Rows of the `nprobe` IVF clusters closest to the query, or None without an IVF partition."""
+        if self.centroids is None:
+            return None
+        nprobe = min(self.nprobe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([
+            self.list_rows[self.list_offsets[cluster]:self.list_offsets[cluster + 1]] for cluster in probed
+        ]))
+
+    def search(self, query_vector: list[float], top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the rows of the `top_k` most similar documents and their scores, best first."""
+        query = normalize_rows(np.asarray(query_vector, dtype=np.float32))
+        candidates = self._candidate_rows(query)
+        scores = self._score(query, candidates)
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        rows = best if candidates is None else candidates[best]
+        return rows, scores[best]
+
+    def get_similar_documents(self, query_vector: list[float], top_k: int = 3, include_values: bool = False) -> list[dict]:
+        """
+        Get similar documents for a given query from the local index.
+
+        Returns a list of dictionaries with metadata.
+        """
+        with stage("retrieval"):
+            rows, scores = self.search(query_vector, top_k)
+        documents = self.documents.get_documents(rows.tolist(), scores.tolist())
+        if include_values:
+            for document, vector in zip(documents, self.load_rows(rows)):
+                document["values"] = vector
+        return documents
+
+    async def get_similar_documents_async(self, query_vector: list[float], top_k: int = 3, include_values: bool = False) -> list[dict]:
+        """Async version of `get_similar_documents`, the search runs in a worker thread."""
+        return await asyncio.to_thread(self.get_similar_documents, query_vector, top_k, include_values)
+
+
+def build_local_index(parquet_path: str, output_dir: str, dtype: str = "float32", nlist: int = 0, batch_size: int = 4096):
+    """
+    Build a `LocalVectorStore` index from the ACL parquet, streaming it in record batches.
+    If `nlist` is greater than 0, an IVF partition with that many clusters is also built.
+    """
+    parquet = pq.ParquetFile(parquet_path)
+    row_count = parquet.metadata.num_rows
+    os.makedirs(output_dir, exist_ok=True)
+
+    quantize = dtype == "int8"
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(output_dir, EMBEDDINGS_FILE), mode="w+", dtype=np.dtype(dtype), shape=(row_count, EMBEDDING_DIMENSION)
+    )
+    scales = np.empty(row_count, dtype=np.float32) if quantize else None
+    columns = [name for name in ["acl_id", "embedding"] + DOCUMENT_FIELDS if name in parquet.schema_arrow.names]
+
+    start = 0
+    with pa.OSFile(os.path.join(output_dir, DOCUMENTS_FILE), "wb") as sink, pa.ipc.new_file(sink, DOCUMENT_SCHEMA) as writer:
+        for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+            vectors = normalize_rows(decode_embeddings(batch.column("embedding")))
+            end = start + len(vectors)
+            if quantize:
+                row_scales = np.abs(vectors).max(axis=1) / 127
+                row_scales[row_scales == 0] = 1
+                embeddings[start:end] = np.round(vectors / row_scales[:, None]).astype(np.int8)
+                scales[start:end] = row_scales
+            else:
+                embeddings[start:end] = vectors
+            writer.write_batch(to_document_batch(batch))
+            start = end
+            print(f"Indexed {start}/{row_count} documents")
+
+    embeddings.flush()
+    if quantize:
+        np.save(os.path.join(output_dir, SCALES_FILE), scales)
+    if nlist > 0:
+        build_ivf(output_dir, nlist)
+
+
+def build_ivf(output_dir: str, nlist: int, iterations: int = 10, sample_size: int = 50000, seed: int = 0):
+    """
+    Partition the index of `output_dir` into `nlist` clusters with spherical k-means,
+    trained on a sample of the embeddings.
+    """
+    store = LocalVectorStore(output_dir)
+    row_count = len(store.embeddings)
+    rng = np.random.default_rng(seed)
+
+    sample = store.load_rows(np.sort(rng.choice(row_count, min(sample_size, row_count), replace=False)))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        non_empty = np.bincount(assignments, minlength=nlist) > 0
+        centroids[non_empty] = normalize_rows(sums[non_empty])
+
+    assignments = np.empty(row_count, dtype=np.int32)
+    for start in range(0, row_count, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, row_count)
+        assignments[start:end] = np.argmax(store.load_rows(slice(start, end)) @ centroids.T, axis=1)
+
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))])
+    np.save(os.path.join(output_dir, IVF_CENTROIDS_FILE), centroids.astype(np.float32))
+    np.save(os.path.join(output_dir, IVF_OFFSETS_FILE), list_offsets)
+    np.save(os.path.join(output_dir, IVF_ROWS_FILE), np.argsort(assignments, kind="stable"))
+
+
+if __name__ == "__main__":
+    # Example: python -m services.local_vector_store acl-publication-info.74k.parquet local_index --dtype float16 --nlist 256
+    parser = argparse.ArgumentParser(description="Build the local vector index from the ACL parquet.")
+    parser.add_argument("parquet_path")
+    parser.add_argument("output_dir")
+    parser.add_argument("--dtype", choices=["float32", "float16", "int8"], default="float32")
+    parser.add_argument("--nlist", type=int, default=0, help="Number of IVF clusters (0 for exact search)")
+    args = parser.parse_args()
+
+    build_local_index(args.parquet_path, args.output_dir, dtype=args.dtype, nlist=args.nlist)
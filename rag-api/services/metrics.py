@@ -0,0 +1,98 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import Counter, Histogram
+
+# Stage in which the LLM is called with the prompt of each builder in services/prompting.py
+PROMPT_STAGES = {
+    "build_prompt_for_query_refinement": "refinement",
+    "build_prompt_to_check_necessity_of_retrieving_documents": "necessity",
+    "build_prompt_for_initial_message": "answer",
+    "build_prompt_for_intermediate_message_with_new_docs": "answer",
+    "build_prompt_for_intermediate_message_without_new_docs": "answer",
+    "build_prompt_for_conversation_summary": "summary",
+}
+
+STAGE_DURATION = Histogram(
+    "rag_stage_duration_seconds",
+    "Duration of each stage of the RAG pipeline.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+REQUEST_DURATION = Histogram(
+    "rag_request_duration_seconds",
+    "Duration of the HTTP requests, until the response headers are sent.",
+    ["path"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total",
+    "Tokens used by the OpenAI completions, by prompt builder.",
+    ["prompt_builder", "kind"]
+)
+BRANCHES = Counter(
+    "rag_query_branch_total",
+    "Queries by branch of the RAG pipeline.",
+    ["branch"]
+)
+COALESCED_CALLS = Counter(
+    "rag_coalesced_calls_total",
+    "Upstream calls that shared the result of an identical call already in progress.",
+    ["call"]
+)
+UPSTREAM_ERRORS = Counter(
+    "rag_upstream_errors_total",
+    "Errors of the calls to OpenAI and Pinecone, by type.",
+    ["upstream", "error_type"]
+)
+UPSTREAM_RETRIES = Counter(
+    "rag_upstream_retries_total",
+    "Retried calls to OpenAI and Pinecone, after a rate limit, a server error or a timeout.",
+    ["upstream"]
+)
+DEGRADED_QUERIES = Counter(
+    "rag_degraded_queries_total",
+    "Queries that skipped a stage because their deadline ran short or an upstream was unavailable.",
+    ["kind"]
+)
+SHED_REQUESTS = Counter(
+    "rag_shed_requests_total",
+    "Queries rejected with a 503 because too many upstream calls were waiting."
+)
+
+# (stage, seconds) of the stages run by the current request, for the Server-Timing header
+request_timings: ContextVar[list | None] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a stage of the pipeline: records it in the stage histogram and in the timings of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.labels(name).observe(elapsed)
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def record_tokens(prompt_builder: str, usage):
+    """Records the token usage of an OpenAI response."""
+    if usage is None:
+        return
+    LLM_TOKENS.labels(prompt_builder, "prompt").inc(usage.prompt_tokens)
+    LLM_TOKENS.labels(prompt_builder, "completion").inc(usage.completion_tokens)
+
+
+def record_upstream_error(upstream: str, error: Exception):
+    UPSTREAM_ERRORS.labels(upstream, type(error).__name__).inc()
+
+
+def format_server_timing(timings: list) -> str:
+    """Formats the stage timings as a Server-Timing header value, in milliseconds."""
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in timings)
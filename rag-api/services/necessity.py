@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import random
+from collections import OrderedDict
+
+import numpy as np
+
+from config import NECESSITY_HIGH_THRESHOLD, NECESSITY_LOW_THRESHOLD, NECESSITY_ORACLE_SAMPLE_RATE, NECESSITY_STRATEGY
+from services.conversation import ConversationContext
+from services.metrics import request_timings
+from services.openai import openai_service
+from services.pinecone import pinecone_service
+from services.scheduling import request_deadline
+from services.prompting import build_prompt_to_check_necessity_of_retrieving_documents
+
+# Bucket width of the similarity histogram used to calibrate the thresholds
+CALIBRATION_BUCKET = 0.05
+
+
+def parse_necessity_answer(raw_answer: str) -> bool:
+    """Interprets the 'True'/'False' answer of the necessity check prompt."""
+    return "true" in raw_answer.strip().lower()
+
+
+def turn_key(turn: dict) -> str:
+    """Identifies a previous turn by its query and response, to reuse their embeddings."""
+    text = f"{turn.get('query', '')}\x1f{turn.get('response', '')}"
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+async def check_necessity_with_llm(conversation: ConversationContext, user_query: str) -> bool:
+    """Asks the LLM whether new documents have to be retrieved for the query."""
+    prompt_builder = build_prompt_to_check_necessity_of_retrieving_documents.__name__
+    prompt = build_prompt_to_check_necessity_of_retrieving_documents(conversation.render_for(prompt_builder), user_query)
+    raw_answer = await openai_service.get_chat_completion_async(prompt, prompt_builder=prompt_builder)
+    return parse_necessity_answer(raw_answer)
+
+
+class EmbeddingNecessityChecker:
+    """
+    Decides whether new documents have to be retrieved by comparing the refined query embedding
+    with the embeddings of the recent user messages and assistant answers (which describe the
+    documents returned before).
+
+    If the highest cosine similarity is at least `high_threshold`, the query is about the current
+    topic and no documents are retrieved. If it is at most `low_threshold`, it is a new topic and
+    documents are retrieved. In between, the LLM decides.
+
+    A fraction `oracle_sample_rate` of the local decisions is also checked against the LLM in the
+    background, to measure their agreement. The similarities of the turns with an LLM answer are
+    kept in a histogram to calibrate the thresholds.
+
+    The embeddings of the last `cache_size` turns are kept, so a follow-up only embeds the turn
+    added since the previous request of its conversation.
+    """
+    def __init__(self, low_threshold: float, high_threshold: float, oracle_sample_rate: float = 0.0, limit: int = 10, cache_size: int = 4096):
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.oracle_sample_rate = oracle_sample_rate
+        self.limit = limit
+        self.cache_size = cache_size
+        # Turn key (see `turn_key`) -> L2-normalized embeddings of its query and response, as rows
+        self.turn_vectors = OrderedDict()
+        self.stats = {
+            "local_retrieve": 0,
+            "local_no_retrieve": 0,
+            "llm_fallback": 0,
+            "oracle_checks": 0,
+            "oracle_agreements": 0,
+        }
+        # Similarity bucket -> number of LLM answers that were "True" and "False"
+        self.calibration = {}
+        # References to the running oracle tasks, so they are not garbage collected
+        self.tasks = set()
+
+    async def embed_context(self, user_context: list[dict]) -> np.ndarray:
+        """
+        Embeds the recent user messages and assistant answers, as one L2-normalized row each.
+        Only the turns that are not cached yet are embedded.
+        """
+        recent_context = [turn for turn in user_context[-self.limit:] if turn.get("query") or turn.get("response")]
+        keys = [turn_key(turn) for turn in recent_context]
+        vectors = {}
+        for key in keys:
+            if key in self.turn_vectors:
+                self.turn_vectors.move_to_end(key)
+                vectors[key] = self.turn_vectors[key]
+
+        new_turns = {key: turn for key, turn in zip(keys, recent_context) if key not in vectors}
+        if new_turns:
+            queries = [turn["query"] for turn in new_turns.values() if turn.get("query")]
+            responses = [turn["response"] for turn in new_turns.values() if turn.get("response")]
+            query_vectors, response_vectors = await asyncio.gather(
+                pinecone_service.get_embeddings_async(queries),
+                pinecone_service.get_embeddings_async(responses, input_type="passage")
+            )
+            query_vectors, response_vectors = iter(query_vectors), iter(response_vectors)
+            for key, turn in new_turns.items():
+                rows = [next(query_vectors)] if turn.get("query") else []
+                if turn.get("response"):
+                    rows.append(next(response_vectors))
+                vectors[key] = self._cache_turn(key, rows)
+
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack([vectors[key] for key in keys])
+
+    def _cache_turn(self, key: str, rows: list[list[float]]) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.float32)
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        rows = rows / norms
+        self.turn_vectors[key] = rows
+        while len(self.turn_vectors) > self.cache_size:
+            self.turn_vectors.popitem(last=False)
+        return rows
+
+    def similarity(self, query_vector: list[float], context_vectors: np.ndarray) -> float:
+        """Highest cosine similarity between the query and the previous turns."""
+        if len(context_vectors) == 0:
+            return 0.0
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return float(np.max(context_vectors @ query) / norm) if norm > 0 else 0.0
+
+    async def needs_new_documents(self, conversation: ConversationContext, user_query: str, query_vector: list[float], context_vectors: np.ndarray) -> bool:
+        score = self.similarity(query_vector, context_vectors)
+
+        if self.low_threshold < score < self.high_threshold:
+            self.stats["llm_fallback"] += 1
+            decision = await check_necessity_with_llm(conversation, user_query)
+            self._calibrate(score, decision)
+            return decision
+
+        decision = score <= self.low_threshold
+        self.stats["local_retrieve" if decision else "local_no_retrieve"] += 1
+        if random.random() < self.oracle_sample_rate:
+            task = asyncio.create_task(self._compare_with_llm(conversation, user_query, score, decision))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return decision
+
+    async def _compare_with_llm(self, conversation: ConversationContext, user_query: str, score: float, decision: bool):
+        # The oracle check is not part of the request that started it, so it is kept out of its Server-Timing header and deadline
+        request_timings.set(None)
+        request_deadline.set(None)
+        try:
+            llm_decision = await check_necessity_with_llm(conversation, user_query)
+        except Exception:
+            return
+        self.stats["oracle_checks"] += 1
+        if llm_decision == decision:
+            self.stats["oracle_agreements"] += 1
+        self._calibrate(score, llm_decision)
+
+    def _calibrate(self, score: float, llm_decision: bool):
+        bucket = f"{np.floor(score / CALIBRATION_BUCKET) * CALIBRATION_BUCKET:.2f}"
+        counts = self.calibration.setdefault(bucket, {"true": 0, "false": 0})
+        counts["true" if llm_decision else "false"] += 1
+
+    def get_stats(self) -> dict:
+        checks = self.stats["oracle_checks"]
+        return {
+            **self.stats,
+            "oracle_agreement_rate": self.stats["oracle_agreements"] / checks if checks else None,
+            "low_threshold": self.low_threshold,
+            "high_threshold": self.high_threshold,
+            "calibration": dict(sorted(self.calibration.items())),
+        }
+
+
+necessity_checker = None
+if NECESSITY_STRATEGY == "embedding":
+    necessity_checker = EmbeddingNecessityChecker(
+        low_threshold=NECESSITY_LOW_THRESHOLD,
+        high_threshold=NECESSITY_HIGH_THRESHOLD,
+        oracle_sample_rate=NECESSITY_ORACLE_SAMPLE_RATE
+    )
@@ -1,29 +1,136 @@
-from openai import OpenAI
-from fastapi import HTTPException
-from config import OPEN_AI_KEY
+import asyncio
+
+import httpx
+import openai
+from openai import DEFAULT_CONNECTION_LIMITS, AsyncOpenAI, DefaultAsyncHttpxClient
+from config import OPEN_AI_KEY, OPENAI_KEEPALIVE_EXPIRY, SINGLE_FLIGHT
+from services.metrics import PROMPT_STAGES, record_tokens, record_upstream_error, stage
+from services.scheduling import DeadlineExceeded, openai_limiter, time_left, upstream_error, wait_with_timeout
+from services.single_flight import SingleFlight
 
 class OpenAIService:
     def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
+        self.api_key = api_key
+        # The client is created on first use, so importing the module needs neither credentials nor network
+        self._async_client = None
+        # The sampling parameters are fixed, so identical completions are identified by model and prompt
+        self.single_flight = SingleFlight("chat_completion", enabled=SINGLE_FLIGHT)
 
-    def get_chat_completion(self, prompt: str, model_name: str = "gpt-4o-mini") -> str:
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        if self._async_client is None:
+            # Idle connections are kept longer than the httpx default, so the ones opened by `warm_up` are still there for the traffic
+            limits = httpx.Limits(
+                max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+                max_keepalive_connections=DEFAULT_CONNECTION_LIMITS.max_keepalive_connections,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+            )
+            # The retries and timeouts are handled by `openai_limiter`, within the deadline of the request
+            self._async_client = AsyncOpenAI(
+                api_key=self.api_key, max_retries=0, http_client=DefaultAsyncHttpxClient(limits=limits)
+            )
+        return self._async_client
+
+    async def warm_up(self, connections: int = 1):
         """
-        Calls OpenAI's ChatCompletion API with the given prompt and returns the response.
+        Opens `connections` pooled connections to OpenAI (and checks the API key) with concurrent requests
+        to the models endpoint, which costs no tokens.
         """
-        messages = [
+        await asyncio.gather(*(self.async_client.models.list() for _ in range(connections)))
+
+    def _build_messages(self, prompt: str) -> list[dict]:
+        return [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": prompt},
         ]
 
+    async def get_chat_completion_async(self, prompt: str, model_name: str = "gpt-4o-mini", prompt_builder: str = "unknown") -> str:
+        """
+        Calls OpenAI's ChatCompletion API with the given prompt and returns the response.
+        `prompt_builder` is the name of the function of services/prompting.py that built the prompt, used in the metrics.
+        Concurrent calls with the same model and prompt share one completion.
+        The call is scheduled by `openai_limiter`: it raises `UpstreamUnavailable` (or `DeadlineExceeded`)
+        if OpenAI is rate limited or failing after the retries, rejects the request, or if the deadline of the request runs out.
+        """
+        return await self.single_flight.run(
+            (model_name, prompt),
+            lambda: self._create_chat_completion_async(prompt, model_name, prompt_builder),
+            PROMPT_STAGES.get(prompt_builder, "completion")
+        )
+
+    async def _create_chat_completion_async(self, prompt: str, model_name: str, prompt_builder: str) -> str:
+        messages = self._build_messages(prompt)
+        stage_name = PROMPT_STAGES.get(prompt_builder, "completion")
+
         try:
-            completion = self.client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=800
-            )
-            return completion.choices[0].message.content.strip()
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"OpenAI ChatCompletion error: {str(e)}")
+            with stage(stage_name):
+                completion = await openai_limiter.call(
+                    lambda: self.async_client.chat.completions.create(
+                        model=model_name,
+                        messages=messages,
+                        temperature=0.3,
+                        max_tokens=800
+                    ),
+                    stage_name
+                )
+        except openai.APIError as e:
+            # Not worth retrying (e.g. a bad request), and already counted by `openai_limiter`
+            raise upstream_error("openai", e) from e
+        record_tokens(prompt_builder, completion.usage)
+        return completion.choices[0].message.content.strip()
+
+    async def stream_chat_completion(self, prompt: str, model_name: str = "gpt-4o-mini", prompt_builder: str = "unknown"):
+        """
+        Streams the ChatCompletion response, yielding the pieces of text as the model generates them.
+        The completion holds an `openai_limiter` slot until the stream ends or is closed, so the streamed
+        completions count in OPENAI_MAX_CONCURRENCY. Only the start of the stream is retried: once the model
+        sends tokens, an error ends the stream with `UpstreamUnavailable`, and running out of time between two
+        chunks ends it with `DeadlineExceeded`.
+        """
+        messages = self._build_messages(prompt)
+        stage_name = PROMPT_STAGES.get(prompt_builder, "completion")
+
+        try:
+            with stage(stage_name):
+                async with openai_limiter.slot(time_left(stage_name)):
+                    stream = await openai_limiter.call(
+                        lambda: self.async_client.chat.completions.create(
+                            model=model_name,
+                            messages=messages,
+                            temperature=0.3,
+                            max_tokens=800,
+                            stream=True,
+                            stream_options={"include_usage": True}
+                        ),
+                        stage_name,
+                        slot_held=True
+                    )
+                    # Closing the stream (e.g. when the client disconnects) closes the response of OpenAI
+                    async with stream:
+                        chunks = stream.__aiter__()
+                        while True:
+                            try:
+                                # Each chunk must arrive within the time left, so a stalled stream does not hold the slot
+                                chunk = await wait_with_timeout(chunks.__anext__(), time_left(stage_name))
+                            except StopAsyncIteration:
+                                break
+                            except asyncio.TimeoutError as e:
+                                record_upstream_error("openai", e)
+                                raise DeadlineExceeded("openai", "openai did not finish the answer before the deadline of the request") from None
+                            except openai.APIError as e:
+                                record_upstream_error("openai", e)
+                                raise
+                            # The last chunk has no choices, only the token usage
+                            record_tokens(prompt_builder, chunk.usage)
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                yield chunk.choices[0].delta.content
+        except openai.APIError as e:
+            raise upstream_error("openai", e) from e
+
+    async def close(self):
+        """Close the underlying async HTTP connections, if they were opened."""
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
 
 openai_service = OpenAIService(api_key=OPEN_AI_KEY)
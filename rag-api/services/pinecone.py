@@ -1,52 +1,253 @@
-from pinecone import Pinecone
-
-from config import INDEX_NAME, PINECONE_API_KEY
-
-class PineconeService:
-    def __init__(self, api_key: str, index_name: str):
-        # Initialize Pinecone client
-        self.client = Pinecone(api_key=api_key)
-        
-        # Ensure index exists
-        if not self.client.has_index(index_name):
-            print("Pinecone Index not found.")
-        self.index = self.client.Index(index_name)
-
-    def get_embedding(self, text: str) -> list[float]:
-        """Get embedding for a single text using pinecone's embedding endpoint."""
-        response = self.client.inference.embed(
-            model="multilingual-e5-large",
-            inputs=[text],
-            parameters={
-                "input_type": "query"
-            }
-        )
-        return response[0].values
-    
-    def get_similar_documents(self, query_vector: list[float], top_k: int = 3):
+import asyncio
+
+import numpy as np
+from pinecone import PineconeAsyncio, RetryConfig
+
+from config import (
+    DOCUMENT_STORE_PATH, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, INDEX_NAME, PINECONE_API_KEY,
+    SINGLE_FLIGHT
+)
+from services.document_store import DOCUMENT_DEFAULTS, DocumentStore
+from services.embedding_cache import EmbeddingCache
+from services.metrics import stage
+from services.scheduling import pinecone_limiter
+from services.single_flight import SingleFlight
+from services.vector_store import VectorStore
+
+EMBEDDING_MODEL = "multilingual-e5-large"
+# Maximum number of inputs per embed request for multilingual-e5-large
+MAX_EMBEDDING_BATCH_SIZE = 96
+
+class PineconeService(VectorStore):
+    def __init__(self, api_key: str, index_name: str, embedding_cache: EmbeddingCache | None = None, document_store: DocumentStore | None = None):
+        self.api_key = api_key
+        self.index_name = index_name
+        self.embedding_cache = embedding_cache
+        # With a local document store, queries only return ids and scores, and the metadata is read locally
+        self.document_store = document_store
+        # Identical embeddings and queries that run at the same time share one request
+        self.embedding_flights = SingleFlight("embedding", enabled=SINGLE_FLIGHT)
+        self.retrieval_flights = SingleFlight("retrieval", enabled=SINGLE_FLIGHT)
+
+        # The clients are created on first use, inside the running event loop,
+        # so importing the module needs neither credentials nor network
+        self._async_client = None
+        self._async_index = None
+
+    def _get_async_client(self) -> PineconeAsyncio:
+        if self._async_client is None:
+            # The retries are handled by `pinecone_limiter`, within the deadline of the request
+            self._async_client = PineconeAsyncio(api_key=self.api_key, retry_config=RetryConfig(max_retries=0))
+        return self._async_client
+
+    async def _get_async_index(self):
+        if self._async_index is None:
+            client = self._get_async_client()
+            description = await pinecone_limiter.call(lambda: client.describe_index(self.index_name), "retrieval")
+            self._async_index = client.IndexAsyncio(host=description.host)
+        return self._async_index
+
+    async def warm_up(self, connections: int = 1, query_index: bool = True):
+        """
+        Checks that the index exists and opens `connections` pooled connections to the embed endpoint
+        and, if the index is queried (it is not with a local vector store), to the index host.
+        The embed requests also prime the embedding model, so the first query does not pay for it.
+        """
+        client = self._get_async_client()
+        if not await client.has_index(self.index_name):
+            raise RuntimeError(f"Pinecone index {self.index_name} not found")
+        calls = [
+            client.inference.embed(model=EMBEDDING_MODEL, inputs=["warm up"], parameters={"input_type": "query"})
+            for _ in range(connections)
+        ]
+        if query_index:
+            index = await self._get_async_index()
+            calls += [index.describe_index_stats() for _ in range(connections)]
+        await asyncio.gather(*calls)
+
+    async def keep_alive(self, connections: int = 1, query_index: bool = True):
+        """
+        Re-opens `connections` pooled connections with requests that are not billed like embeddings:
+        index checks on the API host and, if the index is queried, index stats on the index host.
+        They go through `pinecone_limiter`, so they count against its rate limit.
+        """
+        client = self._get_async_client()
+        calls = [pinecone_limiter.call(lambda: client.has_index(self.index_name), "keep_alive") for _ in range(connections)]
+        if query_index:
+            index = await self._get_async_index()
+            calls += [pinecone_limiter.call(index.describe_index_stats, "keep_alive") for _ in range(connections)]
+        await asyncio.gather(*calls)
+
+    async def get_embedding_async(self, text: str) -> list[float]:
+        """
+        Get the embedding of a query using Pinecone's embedding endpoint.
+        Concurrent calls with the same text share one embed request.
         """
-        Get similar documents for a given query using Pinecone.
-        
-        Returns a list of dictionaries with metadata.
+        cached = await self._get_cached_embedding(text)
+        if cached is not None:
+            return cached
+        return await self.embedding_flights.run((EMBEDDING_MODEL, text), lambda: self._embed_async(text), "embedding")
+
+    async def _embed_async(self, text: str) -> list[float]:
+        with stage("embedding"):
+            response = await pinecone_limiter.call(
+                lambda: self._get_async_client().inference.embed(
+                    model=EMBEDDING_MODEL,
+                    inputs=[text],
+                    parameters={
+                        "input_type": "query"
+                    }
+                ),
+                "embedding"
+            )
+        return await self._cache_embedding(text, response[0].values)
+
+    async def get_embeddings_async(self, texts: list[str], input_type: str = "query") -> list[list[float]]:
         """
+        Get embeddings for many texts, sending the ones that are not cached
+        in as few embed requests as possible.
+        `input_type` is "query" for search queries and "passage" for the texts being searched.
+        """
+        vectors = [await self._get_cached_embedding(text, input_type) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        for start in range(0, len(missing), MAX_EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + MAX_EMBEDDING_BATCH_SIZE]
+            with stage("embedding"):
+                response = await pinecone_limiter.call(
+                    lambda: self._get_async_client().inference.embed(
+                        model=EMBEDDING_MODEL,
+                        inputs=[texts[i] for i in batch],
+                        parameters={
+                            "input_type": input_type
+                        }
+                    ),
+                    "embedding"
+                )
+            for i, embedding in zip(batch, response):
+                vectors[i] = await self._cache_embedding(texts[i], embedding.values, input_type)
+        return vectors
 
-        # Query the index
-        response = self.index.query(
-            vector=query_vector,
-            top_k=top_k,
-            include_values=False,
-            include_metadata=True
+    async def _get_cached_embedding(self, text: str, input_type: str = "query") -> list[float] | None:
+        if self.embedding_cache is None:
+            return None
+        return await self.embedding_cache.get(EMBEDDING_MODEL, input_type, text)
+
+    async def _cache_embedding(self, text: str, vector: list[float], input_type: str = "query") -> list[float]:
+        if self.embedding_cache is not None:
+            await self.embedding_cache.set(EMBEDDING_MODEL, input_type, text, vector)
+        return vector
+
+    async def get_similar_documents_async(self, query_vector: list[float], top_k: int = 3, include_values: bool = False):
+        """
+        Get the documents most similar to a query vector using Pinecone, as a list of dictionaries with their metadata.
+        Concurrent calls with the same vector and parameters share one query.
+        """
+        key = (np.asarray(query_vector, dtype=np.float32).tobytes(), top_k, include_values)
+        documents = await self.retrieval_flights.run(
+            key, lambda: self._query_async(query_vector, top_k, include_values), "retrieval"
         )
+        # Each caller gets its own documents, which it may modify
+        return [dict(document) for document in documents]
 
-        # Gather results
-        results = []
-        for match in response.matches:
-            meta = match.metadata
-            results.append({
-                "title": meta.get("title", ""),
-                "abstract": meta.get("abstract", ""),
-                "score": match.score  
-            })
+    async def _query_async(self, query_vector: list[float], top_k: int, include_values: bool) -> list[dict]:
+        with stage("retrieval"):
+            index = await self._get_async_index()
+            response = await pinecone_limiter.call(
+                lambda: index.query(
+                    vector=query_vector,
+                    top_k=top_k,
+                    include_values=include_values,
+                    include_metadata=self.document_store is None
+                ),
+                "retrieval"
+            )
+        return self._matches_to_documents(response.matches, include_values)
+
+    def _matches_to_documents(self, matches, include_values: bool = False) -> list[dict]:
+        if self.document_store is not None:
+            results = self.document_store.get_documents_by_id([match.id for match in matches], [match.score for match in matches])
+        else:
+            # Gather results
+            results = []
+            for match in matches:
+                meta = match.metadata
+                results.append({
+                    "id": match.id,
+                    **{name: meta.get(name, default) for name, default in DOCUMENT_DEFAULTS.items()},
+                    "score": match.score
+                })
+        if include_values and matches:
+            # One float32 matrix for all the matches, each document gets a row of it
+            vectors = np.asarray([match.values for match in matches], dtype=np.float32)
+            for document, vector in zip(results, vectors):
+                document["values"] = vector
         return results
 
-pinecone_service = PineconeService(api_key=PINECONE_API_KEY, index_name=INDEX_NAME)
\ No newline at end of file
+    async def close(self):
+        """Close the async index and client sessions, if they were opened."""
+        if self._async_index is not None:
+            await self._async_index.close()
+            self._async_index = None
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+class EmbeddingBatcher:
+    """
+    Collects the `get_embedding` calls made concurrently (e.g. by the items of a batch query)
+    and sends them to `PineconeService.get_embeddings_async` together, waiting at most
+    `max_wait` seconds for a batch to fill up.
+    """
+    def __init__(self, service: PineconeService, max_wait: float = 0.01):
+        self.service = service
+        self.max_wait = max_wait
+        self.pending = []
+        self.flush_handle = None
+        # References to the running embed tasks, so they are not garbage collected
+        self.tasks = set()
+
+    async def get_embedding(self, text: str) -> list[float]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= MAX_EMBEDDING_BATCH_SIZE:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._embed(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _embed(self, batch: list[tuple]):
+        try:
+            vectors = await self.service.get_embeddings_async([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+embedding_cache = None
+if EMBEDDING_CACHE_SIZE > 0:
+    embedding_cache = EmbeddingCache(
+        max_size=EMBEDDING_CACHE_SIZE,
+        ttl=EMBEDDING_CACHE_TTL,
+        path=EMBEDDING_CACHE_PATH or None
+    )
+
+document_store = DocumentStore(DOCUMENT_STORE_PATH) if DOCUMENT_STORE_PATH else None
+
+pinecone_service = PineconeService(
+    api_key=PINECONE_API_KEY, index_name=INDEX_NAME, embedding_cache=embedding_cache, document_store=document_store
+)
@@ -1,6 +1,6 @@
 def build_prompt_for_initial_message(query: str, documents: list[dict]) -> str:
     """
-    Build a prompt that includes up to three context items (title, abstract, score),
+    Build a prompt that includes the retrieved documents (title, abstract, score),
     the user query, and the user context, in English.
     Emphasizes plain text, no LaTeX, no enumerations, minimal special characters.
     Also indicates that the final response must show a similarity score for each relevant document.
@@ -11,12 +11,10 @@ def build_prompt_for_initial_message(query: str, documents: list[dict]) -> str:
         {query}
        
 
-        Below are up to three articles that you found and might be relevant to this query, 
+        Below are up to {count} articles that you found and might be relevant to this query, 
         each with a Score indicating similarity to the user's query:
 
-        1) Title: "{title1}", Abstract: "{abstract1}, Score: {score1}"
-        2) Title: "{title2}", Abstract: "{abstract2}, Score: {score2}"
-        3) Title: "{title3}", Abstract: "{abstract3}, Score: {score3}"
+        {articles}
         
         Your objectives are:
         - Analyze the researcher's query and determine if these articles are actually related to the new question or topic.
@@ -39,40 +37,21 @@ def build_prompt_for_initial_message(query: str, documents: list[dict]) -> str:
         Based on all the above, respond to the researcher in the best possible way in the same language as the user question:
     """
 
-    titles = []
-    abstracts = []
-    scores = []
-    for i in range(3):
-        if i < len(documents):
-            titles.append(documents[i].get("title", ""))
-            abstracts.append(documents[i].get("abstract", ""))
-            scores.append(documents[i].get("score", ""))
-        else:
-            titles.append("")
-            abstracts.append("")
-            scores.append("")
-
     return prompt_template.format(
-        title1=titles[0],
-        abstract1=abstracts[0],
-        score1=scores[0],
-        title2=titles[1],
-        abstract2=abstracts[1],
-        score2=scores[1],
-        title3=titles[2],
-        abstract3=abstracts[2],
-        score3=scores[2],
+        count=len(documents),
+        articles=format_documents(documents),
         query=query,
     ).strip()
 
 
 def build_prompt_to_check_necessity_of_retrieving_documents(
-    user_context: list[dict], user_query: str
+    conversation: str, user_query: str
 ) -> str:
     """
     Build a prompt (string) to check if it is necessary to retrieve more documents 
     based on the user context, in English, returning exactly 'True' or 'False'.
-    Only includes the last 10 messages from user_context.
+    `conversation` is the user context rendered within the token budget of this prompt
+    (see `ConversationContext.render_for` in services/conversation.py).
     (No mention of scores here, as no documents are shown.)
     """
     prompt_template = """
@@ -98,8 +77,6 @@ def build_prompt_to_check_necessity_of_retrieving_documents(
         False (If you think the researcher is asking about the previously recommended articles)
     """
     
-    conversation = get_recent_conversation(user_context)
-        
     return prompt_template.format(
         last_query=user_query,
         previous_queries=conversation.strip()
@@ -107,22 +84,21 @@ def build_prompt_to_check_necessity_of_retrieving_documents(
 
 
 def build_prompt_for_intermediate_message_with_new_docs(
-    user_context: list[dict], new_query: str, new_contexts: list[dict]
+    conversation: str, new_query: str, new_contexts: list[dict]
 ) -> str:
     """
-    Build a prompt that references the conversation so far (user_context),
-    plus up to 3 new documents (new_contexts) with their Score,
+    Build a prompt that references the conversation so far (conversation, rendered from the user context),
+    plus the new documents (new_contexts) with their Score,
     and instructs the LLM to respond in plain text, no LaTeX, no enumerations, minimal special characters.
     Includes the condition: if none of the documents are relevant, simply say so
     and do not mention any differences or similarities.
-    Only includes the last 10 messages from user_context.
     Also includes 'Score' for each retrieved document and instructs the assistant
     to mention the score for each relevant doc in the final answer.
     """
     prompt_template = """
         You are a conversational assistant helping a researcher find relevant information.
         Below is the previous conversation, followed by the new query
-        and up to three newly articles that you found at the knowledge base, 
+        and up to {count} newly articles that you found at the knowledge base, 
         each with a Score indicating similarity to the user's query.
 
         {conversation_history}
@@ -134,9 +110,7 @@ def build_prompt_for_intermediate_message_with_new_docs(
 
 
         Potentially relevant articles (with their Score):
-        1) Title: "{title1}", Abstract: "{abstract1}, Score: {score1}"
-        2) Title: "{title2}", Abstract: "{abstract2}, Score: {score2}"
-        3) Title: "{title3}", Abstract: "{abstract3}, Score: {score3}"
+        {articles}
 
         Your objectives:
         - Review the previous conversation so you don't repeat unnecessary information.
@@ -160,41 +134,18 @@ def build_prompt_for_intermediate_message_with_new_docs(
         Based on this, provide the best possible answer to the researcher in the same language as the new user question:
     """
 
-    # Use the auxiliary function
-    conversation = get_recent_conversation(user_context)
-
-    titles = []
-    abstracts = []
-    scores = []
-    for i in range(3):
-        if i < len(new_contexts):
-            titles.append(new_contexts[i].get("title", ""))
-            abstracts.append(new_contexts[i].get("abstract", ""))
-            scores.append(new_contexts[i].get("score", ""))
-        else:
-            titles.append("")
-            abstracts.append("")
-            scores.append("")
-
     prompt_filled = prompt_template.format(
         conversation_history=conversation.strip(),
         user_query=new_query,
-        title1=titles[0],
-        abstract1=abstracts[0],
-        score1=scores[0],
-        title2=titles[1],
-        abstract2=abstracts[1],
-        score2=scores[1],
-        title3=titles[2],
-        abstract3=abstracts[2],
-        score3=scores[2]
+        count=len(new_contexts),
+        articles=format_documents(new_contexts)
     ).strip()
 
     return prompt_filled
 
 
 def build_prompt_for_intermediate_message_without_new_docs(
-    user_context: list[dict], new_query: str
+    conversation: str, new_query: str
 ) -> str:
     """
     Build a prompt that references the conversation so far, but indicates
@@ -202,7 +153,6 @@ def build_prompt_for_intermediate_message_without_new_docs(
     
     Also states that if the previous documents are not relevant, 
     it should simply say so and not discuss any differences or similarities.
-    Only includes the last 10 messages from user_context.
     (No need to include scores because no new docs are provided here.)
     """
     prompt_template = """
@@ -242,8 +192,6 @@ def build_prompt_for_intermediate_message_without_new_docs(
         Provide the best possible answer to the researcher in the same language as the new user question:
     """
 
-    conversation = get_recent_conversation(user_context)
-
     prompt_filled = prompt_template.format(
         conversation_history=conversation.strip(),
         user_query=new_query
@@ -253,14 +201,13 @@ def build_prompt_for_intermediate_message_without_new_docs(
 
 
 def build_prompt_for_query_refinement(
-    user_context: list[dict], 
+    conversation: str, 
     last_query: str
 ) -> str:
     """
     Build a prompt asking the LLM to refine or enrich the user's last query
-    based on the overall conversation (user_context), so that we can use 
+    based on the overall conversation (conversation, rendered from the user context), so that we can use 
     the resulting query in a vector database for more accurate retrieval.
-    Only includes the last 10 messages from user_context.
     (No mention of scores here, as this is just for refining the query.)
     """
     prompt_template = """
@@ -286,7 +233,6 @@ def build_prompt_for_query_refinement(
 
         Based on all the above, produce the best possible refined query:
     """
-    conversation = get_recent_conversation(user_context)
     prompt_filled = prompt_template.format(
         conversation=conversation.strip(),
         last_query=last_query
@@ -294,14 +240,54 @@ def build_prompt_for_query_refinement(
 
     return prompt_filled
 
-def get_recent_conversation(user_context: list[dict], limit: int = 10) -> str:
+def build_prompt_for_conversation_summary(previous_summary: str, new_turns: str, max_words: int) -> str:
+    """
+    Build a prompt asking the LLM to update the running summary of a conversation
+    with the turns that have left the window of recent messages, so older turns are
+    summarized incrementally instead of being summarized again on every request.
+    """
+    prompt_template = """
+        You are summarizing a conversation between a researcher and an assistant that recommends academic articles.
+
+        Current summary of the conversation:
+        {previous_summary}
+
+        New messages to add to the summary:
+        {new_turns}
+
+        Your goal:
+        - Update the summary so that it also covers the new messages.
+        - Keep the research topics of the researcher, the titles of the recommended articles and their Scores,
+          and any preference or constraint the researcher expressed.
+        - Drop greetings, repetitions and details that are not needed to continue the conversation.
+
+        FORMAT INSTRUCTIONS:
+        - Write in English, in plain text, in at most {max_words} words.
+        - Return only the updated summary, without any additional commentary.
+
+        Updated summary:
+    """
+    prompt_filled = prompt_template.format(
+        previous_summary=previous_summary.strip() or "(empty)",
+        new_turns=new_turns.strip(),
+        max_words=max_words
+    ).strip()
+
+    return prompt_filled
+
+
+def format_documents(documents: list[dict]) -> str:
+    """
+    Format the retrieved documents as the numbered list of the answer prompts, with their title, abstract and Score.
+    """
+    return "\n        ".join(
+        f'{idx}) Title: "{document.get("title", "")}", Abstract: "{document.get("abstract", "")}, Score: {document.get("score", "")}"'
+        for idx, document in enumerate(documents, start=1)
+    )
+
+
+def format_turn(idx: int, turn: dict) -> str:
     """
-    Extract the last `limit` messages from the user context and format them as a conversation string.
+    Format one turn of the user context as it appears in the prompts.
     """
-    recent_context = user_context[-limit:]
-    conversation = ""
-    for idx, turn in enumerate(recent_context, start=1):
-        conversation += (
-            f"User message {idx}: {turn.get('query', '')}\n Assistant answer: {turn.get('response', '')}\n\n"
-        )
-    return conversation.strip()
\ No newline at end of file
+    return f"User message {idx}: {turn.get('query', '')}\n Assistant answer: {turn.get('response', '')}"
@@ -0,0 +1,103 @@
+import asyncio
+import random
+import re
+
+from langdetect import DetectorFactory, detect_langs
+from langdetect.lang_detect_exception import LangDetectException
+
+from config import REFINEMENT_BYPASS, REFINEMENT_BYPASS_LANGUAGES, REFINEMENT_BYPASS_MAX_WORDS, REFINEMENT_BYPASS_SHADOW_RATE
+from services.metrics import request_timings
+from services.scheduling import request_deadline
+
+# Make language detection deterministic
+DetectorFactory.seed = 0
+
+# Words that indicate a conversational message rather than a search phrase
+CONVERSATIONAL_WORDS = {
+    "i", "i'm", "im", "me", "my", "we", "our", "you", "your", "can", "could", "would", "please", "help", "thanks", "hi", "hello",
+}
+MIN_WORDS = 2
+MIN_LANGUAGE_PROBABILITY = 0.8
+
+
+class RefinementBypass:
+    """
+    Decides when a first-turn query can be embedded as it is, skipping the LLM refinement:
+    the query has to be a short, single-sentence search phrase in one of `languages`,
+    without conversational words.
+
+    A fraction `shadow_rate` of the bypassed queries is also refined and retrieved in the
+    background, to measure the overlap between the documents retrieved with and without refinement.
+    """
+    def __init__(self, max_words: int, languages: list[str], shadow_rate: float = 0.0):
+        self.max_words = max_words
+        self.languages = set(languages)
+        self.shadow_rate = shadow_rate
+        self.stats = {"bypassed": 0, "refined": 0, "shadow_comparisons": 0, "shadow_overlap_sum": 0.0}
+        # References to the running shadow tasks, so they are not garbage collected
+        self.tasks = set()
+
+    def should_bypass(self, user_context: list[dict], user_query: str) -> bool:
+        bypass = len(user_context) == 0 and self._is_search_phrase(user_query)
+        self.stats["bypassed" if bypass else "refined"] += 1
+        return bypass
+
+    def _is_search_phrase(self, user_query: str) -> bool:
+        words = re.findall(r"[\w']+", user_query.lower())
+        if not MIN_WORDS <= len(words) <= self.max_words:
+            return False
+        if CONVERSATIONAL_WORDS.intersection(words):
+            return False
+        # More than one sentence, or a question, usually carries context the refinement should condense
+        if re.search(r"[.!?;]\s+\S", user_query.strip()) or "?" in user_query:
+            return False
+        try:
+            best = detect_langs(user_query)[0]
+        except LangDetectException:
+            return False
+        return best.lang in self.languages and best.prob >= MIN_LANGUAGE_PROBABILITY
+
+    def compare_in_background(self, documents: list[dict], refined_retrieval):
+        """
+        With probability `shadow_rate`, awaits `refined_retrieval` (a coroutine returning the documents
+        retrieved with the refined query) in the background and records its overlap with `documents`.
+        """
+        if random.random() >= self.shadow_rate:
+            refined_retrieval.close()
+            return
+        task = asyncio.create_task(self._compare(documents, refined_retrieval))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _compare(self, documents: list[dict], refined_retrieval):
+        # The shadow retrieval is not part of the request that started it, so it is kept out of its Server-Timing header and deadline
+        request_timings.set(None)
+        request_deadline.set(None)
+        try:
+            refined_documents = await refined_retrieval
+        except Exception:
+            return
+        ids = {document["id"] for document in documents}
+        refined_ids = {document["id"] for document in refined_documents}
+        self.stats["shadow_comparisons"] += 1
+        self.stats["shadow_overlap_sum"] += len(ids & refined_ids) / max(len(refined_ids), 1)
+
+    def get_stats(self) -> dict:
+        total = self.stats["bypassed"] + self.stats["refined"]
+        comparisons = self.stats["shadow_comparisons"]
+        return {
+            "bypassed": self.stats["bypassed"],
+            "refined": self.stats["refined"],
+            "bypass_rate": self.stats["bypassed"] / total if total else None,
+            "shadow_comparisons": comparisons,
+            "mean_shadow_overlap": self.stats["shadow_overlap_sum"] / comparisons if comparisons else None,
+        }
+
+
+refinement_bypass = None
+if REFINEMENT_BYPASS:
+    refinement_bypass = RefinementBypass(
+        max_words=REFINEMENT_BYPASS_MAX_WORDS,
+        languages=REFINEMENT_BYPASS_LANGUAGES,
+        shadow_rate=REFINEMENT_BYPASS_SHADOW_RATE
+    )
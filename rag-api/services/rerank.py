@@ -0,0 +1,87 @@
+import re
+
+import numpy as np
+
+from config import RERANK, RERANK_ABSTRACT_BOOST, RERANK_CANDIDATES, RERANK_LAMBDA, RERANK_TITLE_BOOST
+from services.local_vector_store import normalize_rows
+from services.metrics import stage
+
+# Words too common in research questions to boost the documents that contain them
+STOPWORDS = {
+    "the", "and", "for", "with", "about", "from", "into", "that", "this", "these", "those", "what", "which", "how",
+    "are", "was", "were", "can", "does", "using", "based", "paper", "papers", "article", "articles", "research",
+}
+
+
+def query_terms(text: str) -> list[str]:
+    """Distinct lowercase words of the query that are worth matching in the documents."""
+    return sorted({word for word in re.findall(r"\w+", text.lower()) if len(word) > 2 and word not in STOPWORDS})
+
+
+class MMRReranker:
+    """
+    Reorders over-fetched candidates with Maximal Marginal Relevance, so the final documents
+    do not all cover the same subtopic.
+
+    The relevance of a candidate is its cosine similarity to the query, plus `title_boost` and
+    `abstract_boost` times the fraction of the query terms found in its title and abstract.
+    Each pick maximizes `diversity_lambda * relevance - (1 - diversity_lambda) * max similarity
+    to the documents already picked`. Everything runs in a few NumPy operations on the candidate
+    vectors returned by the vector store, without network calls.
+    """
+    def __init__(self, candidates: int, diversity_lambda: float, title_boost: float = 0.0, abstract_boost: float = 0.0):
+        self.candidates = candidates
+        self.diversity_lambda = diversity_lambda
+        self.title_boost = title_boost
+        self.abstract_boost = abstract_boost
+
+    def _lexical_boosts(self, query_text: str, documents: list[dict]) -> np.ndarray:
+        boosts = np.zeros(len(documents), dtype=np.float32)
+        terms = query_terms(query_text)
+        if not terms or (self.title_boost == 0 and self.abstract_boost == 0):
+            return boosts
+        for i, document in enumerate(documents):
+            title = (document.get("title") or "").lower()
+            abstract = (document.get("abstract") or "").lower()
+            boosts[i] = (
+                self.title_boost * sum(term in title for term in terms)
+                + self.abstract_boost * sum(term in abstract for term in terms)
+            ) / len(terms)
+        return boosts
+
+    def rerank(self, query_vector: list[float], query_text: str, documents: list[dict], top_k: int) -> list[dict]:
+        """
+        The `top_k` documents picked by MMR among `documents`, which must include their vectors as "values"
+        (float32 arrays; lists work too, but converting them costs more than the rerank itself).
+        The vectors are dropped from the returned documents, which keep their original score.
+        """
+        with stage("rerank"):
+            if len(documents) <= 1:
+                selected = list(range(len(documents)))
+            else:
+                # The vector stores return the values as float32 arrays, so this is a single copy
+                vectors = normalize_rows(np.asarray([document["values"] for document in documents], dtype=np.float32))
+                query = normalize_rows(np.asarray(query_vector, dtype=np.float32))
+                relevance = vectors @ query + self._lexical_boosts(query_text, documents)
+
+                selected = []
+                max_similarity = np.zeros(len(documents), dtype=np.float32)
+                for _ in range(min(top_k, len(documents))):
+                    scores = self.diversity_lambda * relevance - (1 - self.diversity_lambda) * max_similarity
+                    scores[selected] = -np.inf
+                    best = int(np.argmax(scores))
+                    selected.append(best)
+                    # Only the similarities to the picked documents are needed, not the whole similarity matrix
+                    max_similarity = np.maximum(max_similarity, vectors @ vectors[best])
+
+            return [{key: value for key, value in documents[i].items() if key != "values"} for i in selected]
+
+
+reranker = None
+if RERANK:
+    reranker = MMRReranker(
+        candidates=RERANK_CANDIDATES,
+        diversity_lambda=RERANK_LAMBDA,
+        title_boost=RERANK_TITLE_BOOST,
+        abstract_boost=RERANK_ABSTRACT_BOOST
+    )
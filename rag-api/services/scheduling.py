@@ -0,0 +1,310 @@
+import asyncio
+import math
+import random
+import time
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+
+import openai
+import pinecone
+
+from config import (
+    ANSWER_RESERVE, LOAD_SHED_QUEUE_THRESHOLD, LOAD_SHED_RETRY_AFTER, OPENAI_MAX_CONCURRENCY, OPENAI_RATE_LIMIT,
+    PINECONE_MAX_CONCURRENCY, PINECONE_RATE_LIMIT, REQUEST_DEADLINE, UPSTREAM_MAX_RETRIES, UPSTREAM_RETRY_BASE_DELAY,
+    UPSTREAM_TIMEOUT
+)
+from services.metrics import DEGRADED_QUERIES, SHED_REQUESTS, UPSTREAM_RETRIES, record_upstream_error
+
+# Statuses of the upstream responses that are worth retrying
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Maximum backoff between two attempts, in seconds
+MAX_RETRY_DELAY = 10
+# Seconds a stage needs at least to be worth starting; with less time left before the answer reserve, it is skipped
+MIN_STAGE_SECONDS = {"refinement": 2.0, "necessity": 1.0}
+
+
+class UpstreamUnavailable(Exception):
+    """
+    An upstream call that could not be completed: the upstream kept failing after the retries, or had no capacity.
+    Answered with `status_code` and, if known, a Retry-After header (see main.py).
+    """
+    def __init__(self, upstream: str, message: str, status_code: int = 503, retry_after: float | None = None):
+        super().__init__(message)
+        self.upstream = upstream
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """An upstream call that could not be completed before the deadline of the request."""
+    def __init__(self, upstream: str, message: str):
+        super().__init__(upstream, message, status_code=504)
+
+
+class Deadline:
+    """
+    Time budget of a request. The last `answer_reserve` seconds are kept for the final completion,
+    so the stages before it only get the time left until then.
+    """
+    def __init__(self, seconds: float, answer_reserve: float):
+        self.expires_at = time.monotonic() + seconds
+        self.answer_reserve = answer_reserve
+
+    def time_left(self, stage_name: str) -> float:
+        left = self.expires_at - time.monotonic()
+        return left if stage_name == "answer" else left - self.answer_reserve
+
+    def has_time_for(self, stage_name: str) -> bool:
+        return self.time_left(stage_name) >= MIN_STAGE_SECONDS.get(stage_name, 0)
+
+
+# Deadline of the current request (None outside of the query requests, e.g. in background tasks)
+request_deadline: ContextVar[Deadline | None] = ContextVar("request_deadline", default=None)
+
+
+def start_deadline() -> Deadline:
+    """Starts the deadline of a query request, for the upstream calls made in the current context."""
+    deadline = Deadline(REQUEST_DEADLINE, ANSWER_RESERVE)
+    request_deadline.set(deadline)
+    return deadline
+
+
+def time_left(stage_name: str) -> float:
+    """Seconds an upstream call of the given stage may take, bounded by the deadline of the request."""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return UPSTREAM_TIMEOUT
+    return min(deadline.time_left(stage_name), UPSTREAM_TIMEOUT)
+
+
+def has_time_for(stage_name: str) -> bool:
+    deadline = request_deadline.get()
+    return deadline is None or deadline.has_time_for(stage_name)
+
+
+async def wait_with_timeout(awaitable, timeout: float | None):
+    """
+    Like `asyncio.wait_for`, but never loses a cancellation: before Python 3.12, `asyncio.wait_for` returns
+    the result instead of raising `CancelledError` when the awaitable finishes just as the caller is cancelled,
+    so e.g. a discarded speculative retrieval would go on with its query.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+    except BaseException:
+        task.cancel()
+        # The result or error of the task is not needed anymore, mark it as retrieved
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        raise
+    if not done:
+        task.cancel()
+        await asyncio.wait({task})
+        if task.cancelled():
+            raise asyncio.TimeoutError
+    return task.result()
+
+
+def record_degradation(kind: str):
+    DEGRADED_QUERIES.labels(kind).inc()
+
+
+def is_retryable(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (TimeoutError, asyncio.TimeoutError, openai.APIConnectionError, pinecone.PineconeConnectionError))
+
+
+def upstream_error(upstream: str, error: Exception) -> UpstreamUnavailable:
+    """
+    The error answered for a failed upstream call: a 503 with Retry-After if the upstream is rate limiting, a 502 otherwise.
+    """
+    rate_limited = getattr(error, "status_code", None) == 429
+    retry_after = get_retry_after(error)
+    return UpstreamUnavailable(
+        upstream,
+        f"{upstream} request failed: {error}",
+        status_code=503 if rate_limited else 502,
+        retry_after=retry_after or (LOAD_SHED_RETRY_AFTER if rate_limited else None)
+    )
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """The Retry-After of an upstream error response, in seconds, if it has one."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, in bursts of at most `capacity` calls.
+    Callers reserve their token in arrival order, and wait until it is available.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, max_wait: float) -> float | None:
+        """Takes a token and returns the seconds to wait before using it, or None if that is over `max_wait`."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def refund(self):
+        self.tokens += 1
+
+
+class UpstreamLimiter:
+    """
+    Schedules the calls to one upstream: at most `max_concurrency` of them at the same time and, if `rate` is set,
+    at most `rate` per second. Rate limits, server errors and timeouts are retried with jittered exponential
+    backoff (honoring Retry-After), and every wait is bounded by the deadline of the request.
+    """
+    def __init__(self, name: str, max_concurrency: int, rate: float, max_retries: int, retry_base_delay: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Bursts of up to one second of calls
+        self.bucket = TokenBucket(rate, capacity=max(rate, 1)) if rate > 0 else None
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        # Calls waiting for a slot, to shed load before the queues grow
+        self.waiting = 0
+        self.in_flight = 0
+        # When the last call finished, to tell if the connections to the upstream are idle
+        self.last_call_at = time.monotonic()
+        self.stats = {"calls": 0, "retries": 0, "deadline_exceeded": 0, "failures": 0}
+
+    async def _acquire(self, expires_at: float):
+        await self.semaphore.acquire()
+        try:
+            if self.bucket is not None:
+                wait = self.bucket.reserve(max_wait=expires_at - time.monotonic())
+                if wait is None:
+                    raise asyncio.TimeoutError
+                try:
+                    await asyncio.sleep(wait)
+                except BaseException:
+                    self.bucket.refund()
+                    raise
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, timeout: float):
+        """Waits at most `timeout` seconds for a concurrency slot and a rate token."""
+        self.waiting += 1
+        acquire = asyncio.ensure_future(self._acquire(time.monotonic() + timeout))
+        try:
+            await wait_with_timeout(acquire, timeout)
+        except asyncio.TimeoutError:
+            self.stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded(self.name, f"No {self.name} capacity before the deadline of the request") from None
+        except asyncio.CancelledError:
+            # The slot may have been acquired just as the caller was cancelled
+            if acquire.done() and not acquire.cancelled() and acquire.exception() is None:
+                self.semaphore.release()
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.last_call_at = time.monotonic()
+            self.semaphore.release()
+
+    def _backoff(self, attempt: int, retry_after: float | None) -> float:
+        delay = random.uniform(0, min(MAX_RETRY_DELAY, self.retry_base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def call(self, make_call, stage_name: str, slot_held: bool = False):
+        """
+        Awaits `make_call()` (a function returning a new awaitable on every attempt) within a slot,
+        with at most the time left for `stage_name`, retrying the transient errors.
+        With `slot_held`, the caller already holds a slot (see `slot`), which is kept between the attempts.
+        Every failed attempt is counted in the upstream errors metric, so the callers do not count them again.
+        Raises `DeadlineExceeded` when out of time, and `UpstreamUnavailable` when the retries are exhausted
+        or the upstream answered with an error that is not worth retrying. Other errors are raised as they are.
+        """
+        self.stats["calls"] += 1
+        for attempt in range(self.max_retries + 1):
+            timeout = time_left(stage_name)
+            if timeout <= 0:
+                self.stats["deadline_exceeded"] += 1
+                raise DeadlineExceeded(self.name, f"No time left for the {stage_name} stage")
+            try:
+                async with nullcontext() if slot_held else self.slot(timeout):
+                    return await wait_with_timeout(make_call(), time_left(stage_name))
+            except UpstreamUnavailable:
+                raise
+            except Exception as e:
+                record_upstream_error(self.name, e)
+                if not is_retryable(e):
+                    # Error responses (e.g. a Pinecone ApiException or an OpenAI APIStatusError) are answered like the exhausted retries
+                    if getattr(e, "status_code", None) is not None:
+                        raise upstream_error(self.name, e) from e
+                    raise
+                error = e
+
+            retry_after = get_retry_after(error)
+            delay = self._backoff(attempt, retry_after)
+            if attempt == self.max_retries or delay >= time_left(stage_name):
+                break
+            self.stats["retries"] += 1
+            UPSTREAM_RETRIES.labels(self.name).inc()
+            await asyncio.sleep(delay)
+
+        self.stats["failures"] += 1
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError)) and time_left(stage_name) <= 0:
+            self.stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded(self.name, f"{self.name} did not answer before the deadline of the request") from error
+        raise upstream_error(self.name, error) from error
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "waiting": self.waiting, "in_flight": self.in_flight}
+
+
+openai_limiter = UpstreamLimiter(
+    "openai", max_concurrency=OPENAI_MAX_CONCURRENCY, rate=OPENAI_RATE_LIMIT,
+    max_retries=UPSTREAM_MAX_RETRIES, retry_base_delay=UPSTREAM_RETRY_BASE_DELAY
+)
+pinecone_limiter = UpstreamLimiter(
+    "pinecone", max_concurrency=PINECONE_MAX_CONCURRENCY, rate=PINECONE_RATE_LIMIT,
+    max_retries=UPSTREAM_MAX_RETRIES, retry_base_delay=UPSTREAM_RETRY_BASE_DELAY
+)
+limiters = [openai_limiter, pinecone_limiter]
+
+
+def admit_request():
+    """
+    Sheds the query requests that arrive while more than LOAD_SHED_QUEUE_THRESHOLD calls wait for an upstream:
+    they are answered right away with a 503, instead of queueing until they time out.
+    """
+    for limiter in limiters:
+        if limiter.waiting > LOAD_SHED_QUEUE_THRESHOLD:
+            SHED_REQUESTS.inc()
+            # Roughly the time to drain the queue, if the upstream is rate limited
+            drain = limiter.waiting / limiter.bucket.rate if limiter.bucket is not None else 0
+            raise UpstreamUnavailable(
+                limiter.name, "The server is overloaded, retry later.",
+                status_code=503, retry_after=max(LOAD_SHED_RETRY_AFTER, drain)
+            )
+
+
+def retry_after_header(error: UpstreamUnavailable) -> dict:
+    return {"Retry-After": str(math.ceil(error.retry_after))} if error.retry_after is not None else {}
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import numpy as np
+
+from config import SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD
+
+
+class SemanticCache:
+    """
+    Caches answers to first-turn queries by the embedding of the query.
+
+    A new query reuses a cached answer when the cosine similarity between its embedding
+    and a cached one is at least `threshold`. The embeddings are kept L2-normalized in a
+    preallocated float32 matrix, so a lookup is a single matrix-vector product.
+    When the cache is full, the least recently used entry is evicted.
+    """
+    def __init__(self, capacity: int = 1000, threshold: float = 0.95, dimension: int = 1024):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.entries = [None] * capacity
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _normalize(self, vector: list[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, query_vector: list[float]) -> tuple[dict, float] | None:
+        """
+        Returns the cached entry closest to the query and its similarity,
+        or None if no entry is within the threshold.
+        """
+        query = self._normalize(query_vector)
+        with self.lock:
+            if self.size == 0:
+                self.stats["misses"] += 1
+                return None
+            similarities = self.vectors[:self.size] @ query
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            self.last_used[best] = time.monotonic()
+            self.stats["hits"] += 1
+            return self.entries[best], similarity
+
+    def add(self, query_vector: list[float], document_ids: list[str], answer: str):
+        """Stores the answer and the ids of the documents it was based on."""
+        query = self._normalize(query_vector)
+        with self.lock:
+            if self.size < self.capacity:
+                slot = self.size
+                self.size += 1
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.stats["evictions"] += 1
+            self.vectors[slot] = query
+            self.last_used[slot] = time.monotonic()
+            self.entries[slot] = {"document_ids": document_ids, "answer": answer}
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {**self.stats, "size": self.size, "capacity": self.capacity, "threshold": self.threshold}
+
+
+semantic_cache = SemanticCache(capacity=SEMANTIC_CACHE_SIZE, threshold=SEMANTIC_CACHE_THRESHOLD) if SEMANTIC_CACHE_SIZE > 0 else None
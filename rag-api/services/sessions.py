@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from config import SESSION_MAX_SESSIONS, SESSION_MAX_TURNS, SESSION_STORE, SESSION_STORE_PATH, SESSION_TTL
+
+
+def vector_key(vector: list[float]) -> str:
+    """Identifies a query vector, to find the documents already retrieved with it."""
+    return hashlib.sha256(np.asarray(vector, dtype=np.float32).tobytes()).hexdigest()
+
+
+@dataclass
+class Session:
+    """
+    A conversation kept by the server: its turns, with the ids of the documents retrieved in each of them.
+    Only the turns are stored. The documents retrieved with each (refined) query embedding are also kept in
+    the memory of the worker, so later turns that arrive at the same query reuse them; the query embeddings
+    themselves are reused from the embedding cache.
+    """
+    id: str
+    turns: list[dict] = field(default_factory=list)
+    # Key of the query embedding (see `vector_key`) -> retrieved documents, for the last `max_turns` queries
+    documents: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def context(self) -> list[dict]:
+        """The turns in the format of the `context` of the query requests."""
+        return [{"query": turn["query"], "response": turn["response"]} for turn in self.turns]
+
+    def get_documents(self, vector: list[float]) -> list[dict] | None:
+        return self.documents.get(vector_key(vector))
+
+    def add_documents(self, vector: list[float], documents: list[dict], max_entries: int):
+        self.documents[vector_key(vector)] = documents
+        while len(self.documents) > max_entries:
+            del self.documents[next(iter(self.documents))]
+
+
+def make_turn(query: str, response: str, documents: list[dict] | None) -> dict:
+    return {
+        "query": query,
+        "response": response,
+        "document_ids": [document["id"] for document in documents] if documents is not None else None,
+    }
+
+
+class SessionStore(ABC):
+    """
+    Storage of the sessions, bounded in number and expiring the sessions not used for `ttl` seconds.
+    """
+    def __init__(self, max_sessions: int, ttl: float, max_turns: int):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.stats = {"created": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    async def create(self) -> Session:
+        session = Session(id=uuid.uuid4().hex)
+        await self._insert(session)
+        self.stats["created"] += 1
+        return session
+
+    async def get(self, session_id: str) -> Session | None:
+        session = await self._load(session_id)
+        self.stats["hits" if session is not None else "misses"] += 1
+        return session
+
+    async def add_turn(self, session: Session, query: str, response: str, documents: list[dict] | None):
+        """
+        Appends a turn to the stored session, after the turns other requests may have added since it was loaded,
+        and refreshes `session.turns` with the stored ones.
+        """
+        session.turns = await self._append_turn(session, make_turn(query, response, documents))
+
+    @abstractmethod
+    async def _insert(self, session: Session):
+        pass
+
+    @abstractmethod
+    async def _load(self, session_id: str) -> Session | None:
+        pass
+
+    @abstractmethod
+    async def _append_turn(self, session: Session, turn: dict) -> list[dict]:
+        pass
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "size": len(self)}
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps the sessions in an in-process LRU. Each worker has its own sessions."""
+    def __init__(self, max_sessions: int, ttl: float, max_turns: int):
+        super().__init__(max_sessions, ttl, max_turns)
+        # Session id -> (session, expiration time)
+        self.sessions = OrderedDict()
+
+    async def _insert(self, session: Session):
+        self._touch(session)
+
+    async def _load(self, session_id: str) -> Session | None:
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            return None
+        session, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.sessions[session_id]
+            return None
+        self.sessions.move_to_end(session_id)
+        return session
+
+    async def _append_turn(self, session: Session, turn: dict) -> list[dict]:
+        # The requests of a session share its object, so the turns of concurrent requests are all kept
+        stored = self.sessions.get(session.id, (session, None))[0]
+        stored.turns.append(turn)
+        del stored.turns[:-self.max_turns]
+        self._touch(stored)
+        return stored.turns
+
+    def _touch(self, session: Session):
+        self.sessions[session.id] = (session, time.monotonic() + self.ttl)
+        self.sessions.move_to_end(session.id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def delete(self, session_id: str) -> bool:
+        return self.sessions.pop(session_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite file, shared by all the workers on the same machine
+    (a session can be continued by any worker). Only the turns are stored, and the queries run
+    in a thread so they do not block the event loop. A turn is appended in a single write transaction,
+    so the turns that other workers add to the same session at the same time are not lost.
+    The retrieved documents are kept in the memory of each worker (see `Session`).
+    """
+    def __init__(self, path: str, max_sessions: int, ttl: float, max_turns: int):
+        super().__init__(max_sessions, ttl, max_turns)
+        self.lock = threading.Lock()
+        # The transactions are started explicitly (see `_append_turn_sync`)
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, turns TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self.db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - ttl,))
+        # Session id -> documents retrieved in the session by this worker
+        self.documents = OrderedDict()
+
+    def _get_documents(self, session_id: str) -> dict:
+        documents = self.documents.setdefault(session_id, {})
+        self.documents.move_to_end(session_id)
+        while len(self.documents) > self.max_sessions:
+            self.documents.popitem(last=False)
+        return documents
+
+    async def _insert(self, session: Session):
+        await asyncio.to_thread(self._write_sync, session.id, session.turns)
+        session.documents = self._get_documents(session.id)
+
+    async def _load(self, session_id: str) -> Session | None:
+        turns = await asyncio.to_thread(self._load_sync, session_id)
+        if turns is None:
+            return None
+        return Session(id=session_id, turns=turns, documents=self._get_documents(session_id))
+
+    async def _append_turn(self, session: Session, turn: dict) -> list[dict]:
+        return await asyncio.to_thread(self._append_turn_sync, session.id, turn)
+
+    async def delete(self, session_id: str) -> bool:
+        self.documents.pop(session_id, None)
+        return await asyncio.to_thread(self._delete_sync, session_id)
+
+    def _load_sync(self, session_id: str) -> list[dict] | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT turns FROM sessions WHERE id = ? AND updated_at >= ?", (session_id, time.time() - self.ttl)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _write_sync(self, session_id: str, turns: list[dict]):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self._write(session_id, turns)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _append_turn_sync(self, session_id: str, turn: dict) -> list[dict]:
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock before reading, so no other worker writes the session in between
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT turns FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                turns = json.loads(row[0]) if row is not None else []
+                turns.append(turn)
+                del turns[:-self.max_turns]
+                self._write(session_id, turns)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return turns
+
+    def _write(self, session_id: str, turns: list[dict]):
+        self.db.execute(
+            "INSERT OR REPLACE INTO sessions (id, turns, updated_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(turns), time.time())
+        )
+        # Drop the expired sessions and the least recently used ones above the limit
+        evicted = self.db.execute(
+            "DELETE FROM sessions WHERE updated_at < ? OR id IN ("
+            "SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (time.time() - self.ttl, self.max_sessions)
+        ).rowcount
+        self.stats["evictions"] += evicted
+
+    def _delete_sync(self, session_id: str) -> bool:
+        with self.lock:
+            return self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+session_store = None
+if SESSION_STORE == "memory":
+    session_store = MemorySessionStore(max_sessions=SESSION_MAX_SESSIONS, ttl=SESSION_TTL, max_turns=SESSION_MAX_TURNS)
+elif SESSION_STORE == "sqlite":
+    session_store = SqliteSessionStore(
+        SESSION_STORE_PATH, max_sessions=SESSION_MAX_SESSIONS, ttl=SESSION_TTL, max_turns=SESSION_MAX_TURNS
+    )
@@ -0,0 +1,85 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from functools import partial
+
+from services.metrics import COALESCED_CALLS
+from services.scheduling import DeadlineExceeded, request_deadline, wait_with_timeout
+
+
+class Flight:
+    """An upstream call in progress, and the number of callers waiting for it."""
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Shares one upstream call among the concurrent calls with the same key (e.g. the same first question
+    sent by many users within seconds): the first caller starts the call in a task, and the ones that
+    arrive while it runs wait for its result, or its exception, instead of sending their own.
+
+    A caller that is cancelled stops waiting without cancelling the call for the others;
+    the call is only cancelled when no caller waits for it anymore. Likewise, the call is not bounded
+    by the deadline of the request that started it: each caller waits for it until its own deadline.
+    """
+    def __init__(self, name: str, enabled: bool = True):
+        # Label of the calls in the coalesced calls counter
+        self.name = name
+        self.enabled = enabled
+        # Key -> Flight
+        self.flights = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable], stage_name: str | None = None):
+        """
+        Awaits `call()`, or the call with the same key that is already in progress.
+        `stage_name` (by default the name of the flights) bounds the wait by the deadline of the caller's request.
+        """
+        self.stats["calls"] += 1
+        if not self.enabled:
+            return await call()
+
+        flight = self.flights.get(key)
+        if flight is None:
+            # The task copies the context of the first caller, so its stage timings are attributed to that request
+            flight = self.flights[key] = Flight(asyncio.create_task(self._call(call)))
+            flight.task.add_done_callback(partial(self._finish, key, flight))
+        else:
+            self.stats["coalesced"] += 1
+            COALESCED_CALLS.labels(self.name).inc()
+
+        deadline = request_deadline.get()
+        timeout = deadline.time_left(stage_name or self.name) if deadline is not None else None
+        flight.waiters += 1
+        try:
+            return await wait_with_timeout(asyncio.shield(flight.task), timeout)
+        except asyncio.TimeoutError:
+            if flight.task.done():
+                # The call itself timed out
+                raise
+            raise DeadlineExceeded(self.name, f"{self.name} did not answer before the deadline of the request") from None
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller was cancelled: the next one starts a new call instead of joining a cancelled one
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    async def _call(self, call: Callable[[], Awaitable]):
+        # The call is shared, so it must not fail the other callers when the first one runs out of time
+        request_deadline.set(None)
+        return await call()
+
+    def _forget(self, key: Hashable, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def _finish(self, key: Hashable, flight: Flight, task: asyncio.Task):
+        self._forget(key, flight)
+        # Mark the exception as retrieved, in case the last caller was cancelled just as the call failed
+        if not task.cancelled():
+            task.exception()
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "in_flight": len(self.flights)}
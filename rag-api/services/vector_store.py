@@ -0,0 +1,15 @@
+from abc import ABC, abstractmethod
+
+
+class VectorStore(ABC):
+    """
+    Interface of the document indexes that `rag_query` retrieves from.
+
+    Returns a list of dictionaries with the document id, title, abstract, url, year and score,
+    sorted from the most to the least similar document. With `include_values`, they also
+    include the document vector as "values", e.g. to rerank the documents locally.
+    """
+
+    @abstractmethod
+    async def get_similar_documents_async(self, query_vector: list[float], top_k: int = 3, include_values: bool = False) -> list[dict]:
+        """Get the `top_k` documents most similar to the query vector."""
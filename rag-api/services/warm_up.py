@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+from config import VECTOR_STORE
+from services.conversation import get_encoding
+from services.openai import openai_service
+from services.pinecone import pinecone_service
+from services.scheduling import pinecone_limiter
+
+# Maximum seconds of a warm-up attempt, before it is retried
+WARM_UP_TIMEOUT = 30
+
+
+class Readiness:
+    """
+    Whether the worker can take traffic: its upstream connections are open and the tokenizer is loaded.
+    Reported by /readyz, so a load balancer only sends requests to warm workers.
+    """
+    def __init__(self):
+        self.ready = False
+        self.started_at = time.monotonic()
+        self.attempts = 0
+        self.last_error = None
+        self.warm_up_seconds = None
+
+    def mark_ready(self):
+        self.ready = True
+        self.warm_up_seconds = time.monotonic() - self.started_at
+
+    def get_status(self) -> dict:
+        return {
+            "status": "ready" if self.ready else "warming_up",
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "warm_up_seconds": self.warm_up_seconds,
+        }
+
+
+async def warm_up_once(connections: int):
+    """
+    Opens `connections` connections per upstream, primes the embed endpoint and loads the tokenizer.
+    Every call finishes before returning, even if another one failed.
+    """
+    results = await asyncio.gather(
+        openai_service.warm_up(connections),
+        pinecone_service.warm_up(connections, query_index=VECTOR_STORE != "local"),
+        asyncio.to_thread(get_encoding),
+        return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+
+async def warm_up(readiness: Readiness, connections: int, retry_interval: float, keep_warm_interval: float = 0):
+    """
+    Runs `warm_up_once`, retrying every `retry_interval` seconds until it succeeds.
+    Then, if `keep_warm_interval` is set, keeps the Pinecone connections warm (see `keep_warm`).
+    """
+    while True:
+        readiness.attempts += 1
+        try:
+            await asyncio.wait_for(warm_up_once(connections), timeout=WARM_UP_TIMEOUT)
+        except Exception as e:
+            readiness.last_error = f"{type(e).__name__}: {e}"
+            await asyncio.sleep(retry_interval)
+            continue
+        readiness.mark_ready()
+        break
+    if keep_warm_interval > 0:
+        await keep_warm(readiness, connections, keep_warm_interval)
+
+
+async def keep_warm(readiness: Readiness, connections: int, interval: float):
+    """
+    The Pinecone clients close the connections that are idle for 5 seconds, so the connections opened by the
+    warm-up would be gone before the traffic arrives. Every `interval` seconds without a Pinecone call,
+    they are opened again with cheap requests (see `PineconeService.keep_alive`). Failures are only
+    reported in /readyz: the next request opens its own connection.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if time.monotonic() - pinecone_limiter.last_call_at < interval:
+            continue
+        try:
+            await asyncio.wait_for(
+                pinecone_service.keep_alive(connections, query_index=VECTOR_STORE != "local"),
+                timeout=WARM_UP_TIMEOUT
+            )
+        except Exception as e:
+            readiness.last_error = f"{type(e).__name__}: {e}"
+
+
+readiness = Readiness()
@@ -0,0 +1,166 @@
+import asyncio
+import time
+
+import pytest
+
+from services.scheduling import (
+    Deadline, DeadlineExceeded, TokenBucket, UpstreamLimiter, UpstreamUnavailable, request_deadline, wait_with_timeout
+)
+
+
+class FakeUpstreamError(Exception):
+    """An error response of an upstream, with the attributes read by `is_retryable` and `get_retry_after`."""
+    def __init__(self, status_code: int, retry_after: str | None = None):
+        super().__init__(f"Simulated {status_code}")
+        self.status_code = status_code
+        self.headers = {"retry-after": retry_after} if retry_after is not None else {}
+
+
+def make_limiter(max_retries: int = 2, rate: float = 0, max_concurrency: int = 4) -> UpstreamLimiter:
+    return UpstreamLimiter("test", max_concurrency=max_concurrency, rate=rate, max_retries=max_retries, retry_base_delay=0.001)
+
+
+def failing_call(error: Exception, attempts: list):
+    async def call():
+        attempts.append(time.monotonic())
+        raise error
+    return call
+
+
+def test_rate_limited_upstream_is_unavailable_after_the_retries():
+    attempts = []
+    limiter = make_limiter(max_retries=2)
+    with pytest.raises(UpstreamUnavailable) as raised:
+        asyncio.run(limiter.call(lambda: failing_call(FakeUpstreamError(429, retry_after="0.01"), attempts)(), "test"))
+    assert raised.value.status_code == 503
+    assert raised.value.retry_after == 0.01
+    assert len(attempts) == 3
+    # Each retry waited at least the Retry-After of the upstream
+    assert all(later - earlier >= 0.01 for earlier, later in zip(attempts, attempts[1:]))
+    assert limiter.get_stats() == {
+        "calls": 1, "retries": 2, "deadline_exceeded": 0, "failures": 1, "waiting": 0, "in_flight": 0
+    }
+
+
+def test_failing_upstream_is_a_bad_gateway_after_the_retries():
+    attempts = []
+    with pytest.raises(UpstreamUnavailable) as raised:
+        asyncio.run(make_limiter(max_retries=1).call(lambda: failing_call(FakeUpstreamError(500), attempts)(), "test"))
+    assert raised.value.status_code == 502
+    assert raised.value.retry_after is None
+    assert len(attempts) == 2
+
+
+def test_transient_error_is_retried():
+    attempts = []
+
+    async def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise FakeUpstreamError(503)
+        return "ok"
+
+    assert asyncio.run(make_limiter().call(flaky, "test")) == "ok"
+    assert len(attempts) == 2
+
+
+def test_non_retryable_error_response_is_not_retried():
+    attempts = []
+    with pytest.raises(UpstreamUnavailable) as error:
+        asyncio.run(make_limiter().call(lambda: failing_call(FakeUpstreamError(400), attempts)(), "test"))
+    assert error.value.status_code == 502
+    assert len(attempts) == 1
+
+
+def test_non_upstream_error_is_raised_as_it_is():
+    attempts = []
+    with pytest.raises(ValueError):
+        asyncio.run(make_limiter().call(lambda: failing_call(ValueError("bad input"), attempts)(), "test"))
+    assert len(attempts) == 1
+
+
+def test_no_retry_after_the_deadline():
+    async def main():
+        request_deadline.set(Deadline(seconds=0.05, answer_reserve=0))
+        attempts = []
+        with pytest.raises(UpstreamUnavailable):
+            await make_limiter(max_retries=10).call(
+                lambda: failing_call(FakeUpstreamError(429, retry_after="1"), attempts)(), "test"
+            )
+        # A Retry-After longer than the time left is not waited for
+        assert len(attempts) == 1
+
+        request_deadline.set(Deadline(seconds=0, answer_reserve=0))
+        with pytest.raises(DeadlineExceeded):
+            await make_limiter().call(lambda: failing_call(FakeUpstreamError(500), attempts)(), "test")
+
+    asyncio.run(main())
+
+
+def test_token_bucket_paces_the_calls_after_the_burst():
+    bucket = TokenBucket(rate=10, capacity=2)
+    waits = [bucket.reserve(max_wait=1) for _ in range(4)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(0.1, abs=0.01)
+    assert waits[3] == pytest.approx(0.2, abs=0.01)
+    # A token that would only be available after `max_wait` is not taken
+    assert bucket.reserve(max_wait=0.1) is None
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.3, abs=0.01)
+
+
+def test_limiter_spaces_the_calls_by_its_rate():
+    async def main():
+        # Bursts of up to one second of calls: 10 calls right away, then one every 0.1 s
+        limiter = make_limiter(rate=10, max_concurrency=20)
+        started = []
+
+        async def call():
+            started.append(time.monotonic())
+
+        await asyncio.gather(*(limiter.call(call, "test") for _ in range(13)))
+        return sorted(started)
+
+    started = asyncio.run(main())
+    assert started[9] - started[0] < 0.05
+    assert started[12] - started[0] == pytest.approx(0.3, abs=0.05)
+
+
+def test_limiter_bounds_the_concurrent_calls():
+    async def main():
+        limiter = make_limiter(max_concurrency=2)
+        running = []
+        peak = []
+
+        async def call():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        await asyncio.gather(*(limiter.call(call, "test") for _ in range(6)))
+        return max(peak)
+
+    assert asyncio.run(main()) == 2
+
+
+def test_cancellation_is_not_lost_when_the_call_finishes_at_the_same_time():
+    async def main():
+        call = asyncio.get_running_loop().create_future()
+        waiter = asyncio.create_task(wait_with_timeout(call, 1))
+        await asyncio.sleep(0)
+        call.set_result("late")
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+
+
+def test_wait_with_timeout_cancels_the_call():
+    async def main():
+        call = asyncio.create_task(asyncio.sleep(1))
+        with pytest.raises(asyncio.TimeoutError):
+            await wait_with_timeout(call, 0.01)
+        assert call.cancelled()
+
+    asyncio.run(main())
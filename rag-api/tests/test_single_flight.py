@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from services.scheduling import Deadline, DeadlineExceeded, request_deadline
+from services.single_flight import SingleFlight
+
+
+class CountingCall:
+    """An upstream call that waits until `release` is set, counting how many times it was started."""
+    def __init__(self, result=None, error: Exception | None = None):
+        self.result = result
+        self.error = error
+        self.started = 0
+        self.cancelled = False
+        self.release = asyncio.Event()
+        # Deadline of the request seen by the call
+        self.deadline = None
+
+    async def __call__(self):
+        self.started += 1
+        self.deadline = request_deadline.get()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_concurrent_calls_share_one_call():
+    async def main():
+        flights = SingleFlight("test")
+        call = CountingCall(result="answer")
+        waiters = [asyncio.create_task(flights.run("key", call)) for _ in range(5)]
+        await asyncio.sleep(0)
+        call.release.set()
+        assert await asyncio.gather(*waiters) == ["answer"] * 5
+        assert call.started == 1
+        assert flights.get_stats() == {"calls": 5, "coalesced": 4, "in_flight": 0}
+
+    asyncio.run(main())
+
+
+def test_error_is_raised_to_every_waiter():
+    async def main():
+        flights = SingleFlight("test")
+        call = CountingCall(error=ValueError("upstream failed"))
+        waiters = [asyncio.create_task(flights.run("key", call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        call.release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, ValueError) and str(result) == "upstream failed" for result in results)
+        assert call.started == 1
+        # A failed call is not reused by the next caller
+        retry = CountingCall(result="answer")
+        retry.release.set()
+        assert await flights.run("key", retry) == "answer"
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_does_not_cancel_the_call_for_the_others():
+    async def main():
+        flights = SingleFlight("test")
+        call = CountingCall(result="answer")
+        first = asyncio.create_task(flights.run("key", call))
+        second = asyncio.create_task(flights.run("key", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        call.release.set()
+        assert await second == "answer"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert not call.cancelled
+
+    asyncio.run(main())
+
+
+def test_call_is_cancelled_when_every_waiter_is_cancelled():
+    async def main():
+        flights = SingleFlight("test")
+        call = CountingCall(result="stale")
+        waiters = [asyncio.create_task(flights.run("key", call)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert call.cancelled
+        assert flights.get_stats()["in_flight"] == 0
+        # The next caller starts a new call instead of joining the cancelled one
+        fresh = CountingCall(result="fresh")
+        fresh.release.set()
+        assert await flights.run("key", fresh) == "fresh"
+
+    asyncio.run(main())
+
+
+def test_each_waiter_is_bounded_by_its_own_deadline():
+    async def main():
+        flights = SingleFlight("test")
+        call = CountingCall(result="answer")
+
+        async def run_with_deadline(seconds: float):
+            request_deadline.set(Deadline(seconds, answer_reserve=0))
+            return await flights.run("key", call)
+
+        # The first caller runs out of time, but the call goes on for the caller with a longer deadline
+        short = asyncio.create_task(run_with_deadline(0.01))
+        long = asyncio.create_task(run_with_deadline(5))
+        with pytest.raises(DeadlineExceeded):
+            await short
+        assert not call.cancelled
+        call.release.set()
+        assert await long == "answer"
+        assert call.started == 1
+        # The shared call does not run under the deadline of the first caller
+        assert call.deadline is None
+
+    asyncio.run(main())
+
+
+def test_disabled_flights_do_not_share_calls():
+    async def main():
+        flights = SingleFlight("test", enabled=False)
+        call = CountingCall(result="answer")
+        call.release.set()
+        await asyncio.gather(flights.run("key", call), flights.run("key", call))
+        assert call.started == 2
+
+    asyncio.run(main())